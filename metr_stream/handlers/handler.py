@@ -4,23 +4,58 @@ def get_data_handler(name):
     from .shapefile import ShapefileHandler
     from .obs import ObsHandler
     from .static import StaticHandler
+    from .radars import RadarSitesHandler
 
     handler_dict = {
         'level2radar': Level2Handler,
         'shapefile': ShapefileHandler,
         'obs': ObsHandler,
         'gui': StaticHandler,
+        'radars': RadarSitesHandler,
     }
 
     return handler_dict[name]
 
 
+# Optional payload layouts a client can ask for in its hello. Handlers list the ones they can produce in `features`
+# and get the ones the client asked for as a keyword argument; everyone else gets the layout old clients expect.
+data_features = ['station_tables']
+
+
 class DataHandler(object):
+    features = []
+
+    @property
+    def wire_id(self):
+        # The 'handler' clients see in messages and use to deactivate. Usually the same as the hub's id.
+        return self.id
+
+    def start(self):
+        # Called when the first subscriber activates this handler
+        pass
+
+    def stop(self):
+        # Called when the last subscriber deactivates this handler
+        pass
+
     async def fetch(self):
         raise NotImplementedError(f"fetch() is not implemented for {self.__class__.__name___}")
 
-    def post_fetch(self):
-        pass
+    def cache_writes(self):
+        # (key, function) pairs for the background cache writer to run after a fetch
+        return []
+
+    def session_messages(self):
+        # (key, message) pairs every subscriber needs once per session, before any data that refers to them
+        return []
+
+    def delta(self, base, data):
+        # Message with only what changed between two fetches, or None to always send the whole thing
+        return None
+
+    def snapshot(self):
+        # Message for someone who subscribes between fetches, if the last one sent isn't enough by itself
+        return None
 
     def data_check_intv(self):
         return 30 * 24 * 3600
@@ -0,0 +1,331 @@
+
+import asyncio
+import logging
+import zlib
+from collections import OrderedDict
+
+from metr_stream.utils.errors import StaleDataError, NoNewDataError
+from metr_stream.utils.frame import encode_json, encode_binary
+from metr_stream.utils.payload_cache import PayloadCache
+from metr_stream.utils.scheduler import get_scheduler
+from metr_stream.utils.writer import get_cache_writer
+
+_hub = None
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        _hub = HandlerHub()
+
+    return _hub
+
+
+def init_hub(**kwargs):
+    global _hub
+    _hub = HandlerHub(**kwargs)
+    return _hub
+
+
+def set_hub(hub):
+    # For websocket workers, which hand subscriptions off to the ingest process (see handlers/relay.py)
+    global _hub
+    _hub = hub
+    return _hub
+
+
+class Subscription(object):
+    def __init__(self, handler):
+        self.handler = handler
+        self.subscribers = []
+        self.last_data = None
+
+        # Subscribers that asked for deltas, and the recent frames they can be computed against
+        self.deltas = {}
+        self.history = OrderedDict()
+
+        # Content hash of what each subscriber already has, for handlers whose data has one
+        self.known_hashes = {}
+
+
+class DeltaState(object):
+    def __init__(self):
+        self.acked = None
+        self.n_deltas = 0
+
+
+# One fetch loop per distinct handler id, no matter how many connections are subscribed to it. Each result is
+# serialized once and broadcast to every subscriber.
+class HandlerHub(object):
+    _compressed_prefixes = ['shapefile', 'level2radar', 'obs']
+
+    def __init__(self, payload_cache_bytes=256 * 1024 * 1024, keyframe_every=12, delta_history=16):
+        self._subs = {}
+        self._payload_cache = PayloadCache(max_bytes=payload_cache_bytes)
+        self._keyframe_every = keyframe_every
+        self._delta_history = delta_history
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.DEBUG)
+
+    async def subscribe(self, handler, subscriber, delta=False, known_hash=None):
+        sub = self._subs.get(handler.id)
+        if sub is None:
+            sub = Subscription(handler)
+            sub.subscribers.append(subscriber)
+            if delta:
+                sub.deltas[subscriber] = DeltaState()
+            if known_hash is not None:
+                sub.known_hashes[subscriber] = known_hash
+            self._subs[handler.id] = sub
+
+            self._logger.debug(f"Starting fetch loop for {handler.id}")
+            handler.start()
+            return await self._fetch(sub, first_time=True)
+
+        if subscriber not in sub.subscribers:
+            sub.subscribers.append(subscriber)
+        if delta:
+            sub.deltas[subscriber] = DeltaState()
+        else:
+            sub.deltas.pop(subscriber, None)
+        sub.known_hashes.pop(subscriber, None)
+        if known_hash is not None:
+            sub.known_hashes[subscriber] = known_hash
+
+        self._logger.debug(f"Sharing {handler.id} with {len(sub.subscribers)} subscribers")
+
+        # If the first fetch is still in flight, the new subscriber gets the result when it's broadcast.
+        await self._send_latest(sub, subscriber)
+        return True
+
+    async def resend(self, handler_id, subscriber):
+        # Sends the latest data for a handler to a subscriber again
+        sub = self._subs.get(handler_id)
+        if sub is not None:
+            await self._send_latest(sub, subscriber)
+
+    async def _send_latest(self, sub, subscriber):
+        try:
+            last_data = sub.handler.snapshot()
+        except Exception as exc:
+            self._logger.error(f"Error getting a snapshot of {sub.handler.id}: {exc}")
+            last_data = None
+
+        if last_data is None:
+            last_data = sub.last_data
+
+        if last_data is not None:
+            last_data = self._revalidate(sub, subscriber, last_data) or last_data
+            frame = self._encode(last_data, _wire_format(subscriber))
+            await self._send(sub, subscriber, frame, last_data)
+
+    def unsubscribe(self, handler_id, subscriber):
+        sub = self._subs.get(handler_id)
+        if sub is None or subscriber not in sub.subscribers:
+            return
+
+        sub.subscribers.remove(subscriber)
+        sub.deltas.pop(subscriber, None)
+        sub.known_hashes.pop(subscriber, None)
+        if len(sub.subscribers) == 0:
+            self._logger.debug(f"Stopping fetch loop for {handler_id}")
+            get_scheduler().cancel(handler_id)
+            sub.handler.stop()
+            del self._subs[handler_id]
+
+    def ack(self, handler_id, subscriber, valid):
+        # The subscriber has applied the frame with these valid times, so later deltas can be against it
+        sub = self._subs.get(handler_id)
+        if sub is None or subscriber not in sub.deltas:
+            return
+
+        sub.deltas[subscriber].acked = tuple(valid)
+
+    def n_subscribers(self, handler_id):
+        sub = self._subs.get(handler_id)
+        return 0 if sub is None else len(sub.subscribers)
+
+    async def _fetch(self, sub, first_time=True):
+        handler = sub.handler
+
+        success = True
+        try:
+            req_data = await handler.fetch(first_time=first_time)
+        except StaleDataError as exc:
+            self._logger.error(f"Stale data in {exc.handler}")
+            req_data = {'handler': exc.handler, 'error':'stale data'}
+            success = False
+        except NoNewDataError as exc:
+            self._logger.info(f"No new data for {exc.handler}")
+            self._schedule(sub)
+            return success
+        except Exception as exc:
+            self._logger.error(f"Error in {handler.id}: {exc}")
+            req_data = {'handler': handler.wire_id, 'error':'internal server error'}
+            success = False
+
+        self._schedule(sub)
+
+        if success:
+            sub.last_data = req_data
+
+            frame_id = _frame_id(req_data)
+            if len(sub.deltas) > 0 and frame_id is not None:
+                sub.history[frame_id] = req_data
+                sub.history.move_to_end(frame_id)
+                while len(sub.history) > self._delta_history:
+                    sub.history.popitem(last=False)
+
+        await self._broadcast(sub, req_data)
+
+        writer = get_cache_writer()
+        for key, write in handler.cache_writes():
+            await writer.submit(key, write)
+
+        return success
+
+    def _schedule(self, sub):
+        # The next check goes in once this one is done, so the handler can base it on what it just saw
+        if self._subs.get(sub.handler.id) is not sub:
+            return
+
+        async def do_fetch():
+            if self._subs.get(sub.handler.id) is sub:
+                await self._fetch(sub, first_time=False)
+
+        get_scheduler().schedule(sub.handler.id, sub.handler.data_check_intv(), do_fetch)
+
+    async def _broadcast(self, sub, req_data):
+        sends = []
+        frames = {}
+        for subscriber in list(sub.subscribers):
+            wire_format = _wire_format(subscriber)
+
+            not_modified = self._revalidate(sub, subscriber, req_data)
+            if not_modified is not None:
+                sends.append(self._send(sub, subscriber, self._encode(not_modified, wire_format), not_modified))
+                continue
+
+            base_id = self._delta_base(sub, subscriber, req_data)
+            if (wire_format, base_id) not in frames:
+                msg = None
+                if base_id is not None:
+                    msg = sub.handler.delta(sub.history[base_id], req_data)
+                if msg is None:
+                    base_id = None
+                    msg = req_data
+                else:
+                    msg['base'] = list(base_id)
+                frames[(wire_format, base_id)] = self._encode(msg, wire_format)
+
+            state = sub.deltas.get(subscriber)
+            if state is not None and 'error' not in req_data:
+                state.n_deltas = 0 if base_id is None else state.n_deltas + 1
+
+            sends.append(self._send(sub, subscriber, frames[(wire_format, base_id)], req_data))
+
+        for (wire_format, base_id), (payload, is_binary) in frames.items():
+            kind = "keyframe" if base_id is None else "delta"
+            self._logger.info(f"Broadcasting {len(payload)} bytes ({wire_format} {kind}) for {sub.handler.id}")
+
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self._logger.error(f"Error sending {sub.handler.id}: {result}")
+
+    async def _send(self, sub, subscriber, frame, msg):
+        # Anything the data refers to that this subscriber hasn't been sent yet this session goes first
+        sent = getattr(subscriber, 'session_keys', None)
+        for session_key, session_msg in sub.handler.session_messages():
+            if sent is not None and session_key in sent:
+                continue
+
+            payload, is_binary = self._encode(session_msg, _wire_format(subscriber))
+            await subscriber.send_message(payload, is_binary=is_binary)
+            if sent is not None:
+                sent.add(session_key)
+
+        # A frame still waiting to go out to a slow subscriber gets replaced by a newer one for the same handler, except
+        # pieces of a progressive sweep, which are only any good all together. A "not modified" leaves the frame it
+        # refers to in place. Anything with a hash has already gone into known_hashes, so it can't be dropped to make
+        # room, or the subscriber would be told it's not modified without ever having gotten it.
+        key = None if 'partial' in msg else sub.handler.id
+        payload, is_binary = frame
+        await subscriber.send_message(payload, is_binary=is_binary, key=key, replace=not msg.get('not_modified', False),
+                                      droppable='hash' not in msg)
+
+    def _revalidate(self, sub, subscriber, req_data):
+        # A tiny "not modified" message if the subscriber already has content with this hash, otherwise None. Either
+        # way, the subscriber has it after this send.
+        content_hash = req_data.get('hash')
+        if content_hash is None:
+            return None
+
+        known_hash = sub.known_hashes.get(subscriber)
+        sub.known_hashes[subscriber] = content_hash
+        if known_hash != content_hash:
+            return None
+        return {'handler': req_data['handler'], 'not_modified': True, 'hash': content_hash}
+
+    def _delta_base(self, sub, subscriber, req_data):
+        # Id of the frame this subscriber should get a delta against, or None if it needs the whole thing
+        state = sub.deltas.get(subscriber)
+        if state is None or 'error' in req_data or state.n_deltas >= self._keyframe_every:
+            return None
+
+        if state.acked is None or state.acked not in sub.history:
+            return None
+        return state.acked
+
+    def _encode(self, req_data, wire_format='json'):
+        # Products with a valid time never change once they're made, so the wire frame can be reused by any later
+        # fetch of the same product.
+        key = self._cache_key(req_data, wire_format)
+        if key is not None:
+            frame = self._payload_cache.get(key)
+            if frame is not None:
+                self._logger.debug(f"Payload cache hit for {key[0]} ({self._payload_cache.stats()})")
+                return frame
+
+        frame = self._encode_frame(req_data, wire_format)
+        if key is not None:
+            self._payload_cache.put(key, *frame)
+            self._logger.debug(f"Payload cache miss for {key[0]} ({self._payload_cache.stats()})")
+        return frame
+
+    def payload_cache_stats(self):
+        return self._payload_cache.stats()
+
+    def _cache_key(self, req_data, wire_format):
+        # Deltas and pieces of products depend on what each subscriber already has, so they're not worth keeping around
+        if 'base' in req_data or 'partial' in req_data:
+            return None
+
+        valid = _frame_id(req_data)
+        if valid is None:
+            return None
+        return (req_data['handler'], valid, wire_format)
+
+    def _encode_frame(self, req_data, wire_format):
+        compressed = any(req_data['handler'].startswith(pfx) for pfx in HandlerHub._compressed_prefixes)
+        if compressed and wire_format == 'binary':
+            return zlib.compress(encode_binary(req_data)), True
+
+        data_json = encode_json(req_data)
+        if compressed:
+            return zlib.compress(data_json.encode('utf-8')), True
+        return data_json, False
+
+
+def _frame_id(req_data):
+    if 'error' in req_data or 'entities' not in req_data:
+        return None
+
+    valid = tuple(ent.get('valid') for ent in req_data['entities'])
+    if any(v is None for v in valid):
+        return None
+    return valid
+
+
+def _wire_format(subscriber):
+    return getattr(subscriber, 'wire_format', 'json')
@@ -2,7 +2,9 @@
 import numpy as np
 
 import os
+import asyncio
 import logging
+import random
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
 
@@ -18,36 +20,34 @@ from datetime import datetime, timedelta
 import pytz
 import json
 import zlib
-import base64
-import struct
 import re
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict, Counter, deque
+from statistics import median
 
 from metr_stream.handlers.handler import DataHandler
-from metr_stream.utils.download import download
-from metr_stream.utils.static import get_static
-from metr_stream.utils.cache import Cache
+from metr_stream.utils.download import download, download_range
+from metr_stream.utils.ldm import complete_records, sweep_ends, volume_header_size
+from metr_stream.utils.pool import get_decode_pool
+from metr_stream.utils.scheduler import get_scheduler
+from metr_stream.utils.stations import radars
+from metr_stream.utils.cache import SweepCache
 from metr_stream.utils.errors import NoNewDataError
 
 _url_base = "http://mesonet-nexrad.agron.iastate.edu/level2/raw"
-_wsr_88ds = None
+_sweep_cache = None
+_volume_store = None
+_prefetcher = None
 _recent_td = timedelta(hours=1)
 _remote_tz = pytz.timezone('America/Chicago')
 
-def radar_info():
-    global _wsr_88ds
-    if _wsr_88ds is None:
-        _wsr_88ds = get_static('wsr88ds.json')
-
-    return _wsr_88ds
-
-
 async def check_recent():
     def parse_dt(dt_str):
         return datetime.strptime(dt_str, "%Y-%m-%d %H:%M").replace(tzinfo=_remote_tz).astimezone(pytz.utc).replace(tzinfo=None)
 
-    radar_ids = [ st['id'] for st in radar_info() ]
+    radar_ids = radars()
 
-    html = (await download(_url_base)).decode('utf-8')
+    html = (await download(_url_base, conditional=True)).decode('utf-8')
 
     rem_sites = re.findall("href=\"([\w\d]{4})/\".*?([\d]{4}-[\d]{2}-[\d]{2} [\d]{2}:[\d]{2})", html)
     rem_sites = [ (site, parse_dt(dt)) for site, dt in rem_sites if site in radar_ids ]
@@ -57,53 +57,262 @@ async def check_recent():
 
 
 async def check_recent_site(site):
-    def get_recent_dt(line):
-        if line == "":
+    index = SiteIndex.get(site)
+    await index.refresh()
+    return index.volumes_since(datetime.utcnow() - _recent_td)
+
+
+class SiteIndex(object):
+    # Shared index of the volumes listed in a site's dir.list. Only the lines that are new since the last refresh get
+    # parsed.
+    #
+    # The index also decides when the site is next worth checking. It learns the volume cadence from the listed
+    # times and how long after its start time a volume shows up, and checks just after the next one should appear.
+    # If it isn't there yet, the checks back off (with jitter, so sites don't fall into step). Every handler for the
+    # site is scheduled off of the same `next_check`, so their checks come due together and share one refresh.
+    ttl = 5
+    default_intv = 60
+    check_margin = 2
+    min_backoff = 10
+    max_backoff = 120
+    _indexes = {}
+
+    def __init__(self, site):
+        self.site = site
+        self._dts = []
+        self._last_line = None
+        self._refreshed = None
+        self._lock = asyncio.Lock()
+
+        self.next_check = None
+        self._predicted = None
+        self._n_misses = 0
+        self._lags = deque(maxlen=10)
+        self._errors = deque(maxlen=50)
+
+    @classmethod
+    def get(cls, site):
+        if site not in cls._indexes:
+            cls._indexes[site] = cls(site)
+        return cls._indexes[site]
+
+    async def refresh(self, force=False):
+        async with self._lock:
+            now = datetime.utcnow()
+            if not force and self._refreshed is not None:
+                if now - self._refreshed < timedelta(seconds=SiteIndex.ttl):
+                    return
+                if self.next_check is not None and now < self.next_check:
+                    return
+
+            url = f"{_url_base}/{self.site}/dir.list"
+            txt = await download(url, conditional=True)
+            self._refreshed = now = datetime.utcnow()
+
+            lines = [ line for line in txt.decode('utf-8').split("\n") if line != "" ]
+            prev_newest = self.newest()
+            self._update(lines)
+            self._plan(now, prev_newest)
+
+    def _plan(self, now, prev_newest):
+        newest = self.newest()
+        if prev_newest is not None and newest is not None and newest > prev_newest:
+            self._lags.append((now - newest).total_seconds())
+            self._n_misses = 0
+            if self._predicted is not None:
+                error = (now - self._predicted).total_seconds()
+                self._errors.append(error)
+                _logger.info(f"{self.site} volume at {newest.strftime('%H%M:%S UTC')} seen {error:+.0f} s from "
+                             f"predicted, {self._lags[-1]:.0f} s after volume start")
+        elif self._predicted is not None and now >= self._predicted:
+            self._n_misses += 1
+
+        self._predicted = self._predict()
+        if self._predicted is None:
+            delay = SiteIndex.default_intv
+        elif self._predicted > now:
+            delay = (self._predicted - now).total_seconds() + SiteIndex.check_margin
+        else:
+            backoff = min(SiteIndex.min_backoff * 2 ** max(self._n_misses - 1, 0), SiteIndex.max_backoff)
+            delay = backoff * random.uniform(0.8, 1.2)
+
+        self.next_check = now + timedelta(seconds=delay)
+
+    def _predict(self):
+        # The next volume should start one cadence after the newest one and show up no sooner than the quickest any
+        # recent volume has.
+        if len(self._dts) < 2:
             return None
 
-        dt = datetime.strptime(line[-13:], '%Y%m%d_%H%M')
-        return dt if dt >= datetime.utcnow() - _recent_td else None
+        recent = self._dts[-7:]
+        cadence = median((dt2 - dt1).total_seconds() for dt1, dt2 in zip(recent[:-1], recent[1:]))
+        lag = min(self._lags) if len(self._lags) > 0 else 0
+        return self._dts[-1] + timedelta(seconds=(cadence + lag))
+
+    def seconds_to_check(self):
+        if self.next_check is None:
+            return SiteIndex.default_intv
+        return max((self.next_check - datetime.utcnow()).total_seconds(), 1)
+
+    @classmethod
+    def poll_stats(cls):
+        return {site: index.stats() for site, index in cls._indexes.items()}
+
+    def stats(self):
+        n = max(len(self._errors), 1)
+        return {'predicted': self._predicted, 'next_check': self.next_check, 'n_misses': self._n_misses,
+                'mean_error': sum(self._errors) / n, 'mean_abs_error': sum(abs(e) for e in self._errors) / n}
+
+    def _update(self, lines):
+        if len(lines) == 0:
+            return
+
+        # The listing only ever grows at the end (old files fall off the top), so everything after the last line we
+        # saw is new. If that line is gone, start over.
+        new_lines = lines
+        if self._last_line is not None:
+            try:
+                idx = len(lines) - 1 - lines[::-1].index(self._last_line)
+            except ValueError:
+                self._dts = []
+            else:
+                new_lines = lines[(idx + 1):]
+
+        for line in new_lines:
+            try:
+                dt = datetime.strptime(line[-13:], '%Y%m%d_%H%M')
+            except ValueError:
+                continue
+
+            if len(self._dts) == 0 or dt > self._dts[-1]:
+                self._dts.append(dt)
+            elif dt not in self._dts:
+                insort(self._dts, dt)
+
+        self._last_line = lines[-1]
+
+        # No need to hang on to anything that's too old to ever be asked for
+        cutoff = datetime.utcnow() - 2 * _recent_td
+        self._dts = self._dts[bisect_left(self._dts, cutoff):]
+
+    def newest(self):
+        return self._dts[-1] if len(self._dts) > 0 else None
+
+    def volumes_since(self, dt):
+        return self._dts[bisect_left(self._dts, dt):]
+
+
+def sweep_cache():
+    global _sweep_cache
+    if _sweep_cache is None:
+        _sweep_cache = SweepCache(Level2Handler._cache_dir, timeout=timedelta(minutes=15))
+
+    return _sweep_cache
+
 
-    url = f"{_url_base}/{site}/dir.list"
-    txt = await download(url)
+def volume_store():
+    global _volume_store
+    if _volume_store is None:
+        _volume_store = VolumeStore()
 
-    recent = [ get_recent_dt(line) for line in txt.decode('utf-8').split("\n") ]
-    return [ dt for dt in recent if dt is not None ]    
+    return _volume_store
 
 
-def _cache_fname(cache_dir, site, field, elev):
-    def fname(dt):
-        return f"{cache_dir}/{site}_{field}_{elev:04.1f}_{dt.strftime('%Y%m%d_%H%M')}.json"
-    return fname
+def init_volume_store(**kwargs):
+    global _volume_store
+    _volume_store = VolumeStore(**kwargs)
+    return _volume_store
+
+
+def prefetcher():
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = Prefetcher()
+
+    return _prefetcher
+
+
+def init_prefetcher(**kwargs):
+    global _prefetcher
+    _prefetcher = Prefetcher(**kwargs)
+    return _prefetcher
 
 
 class Level2Handler(DataHandler):
     _cache_dir = "data/l2"
 
-    def __init__(self, site, field, elev):
+    _ingest_modes = ['volume', 'stream', 'progressive']
+
+    def __init__(self, site, field, elev, encoding='float32', ingest='volume', max_range=None, sector=None,
+                 decimate=None, resolution=None):
+        if encoding not in RadarSweep._encodings:
+            raise ValueError(f"Unknown sweep encoding '{encoding}'")
+        if ingest not in Level2Handler._ingest_modes:
+            raise ValueError(f"Unknown ingest mode '{ingest}'")
+
+        self._lod = LevelOfDetail(max_range=max_range, sector=sector, decimate=decimate, resolution=resolution)
+        if self._lod.is_full():
+            self._lod = None
+        elif ingest == 'progressive':
+            raise ValueError("Progressive ingest always sends full-resolution sweeps")
+
         self._site = site
         self._field = field
         self._elev = elev
-        self._radar_vols = []
-
-        self._cache = Cache(_cache_fname(Level2Handler._cache_dir, self._site, self._field, self._elev),
-                            timeout=timedelta(minutes=15))
+        self._encoding = encoding
+        self._ingest = ingest
+        self._last_vol = None
 
         self._last_dt_sent = None
+        self._progress_sweep = None
+        self._n_rays_sent = None
 
         int_deg = int(np.floor(self._elev))
         frc_deg = int((self._elev - int_deg) * 10)
         self.id = f"level2radar.{self._site}.{self._field}.{int_deg:02d}p{frc_deg:1d}"
+        if self._encoding != 'float32':
+            self.id += f".{self._encoding}"
+        if self._ingest != 'volume':
+            self.id += f".{self._ingest}"
+        if self._lod is not None:
+            self.id += f".{self._lod.id}"
+
+    def start(self):
+        volume_store().subscribe(self._site, self._field)
+        if self._ingest == 'volume':
+            prefetcher().activated(self._site, self._field)
+        else:
+            RadarVolumeStream.subscribe(self._site)
 
-    async def fetch(self, first_time=True):
-        self._radar_vols = [ rv for rv in self._radar_vols if rv.timestamp > (datetime.utcnow() - timedelta(hours=2)) ]
+    def stop(self):
+        volume_store().unsubscribe(self._site, self._field)
+        if self._ingest == 'volume':
+            prefetcher().deactivated(self._site, self._field)
+        else:
+            RadarVolumeStream.unsubscribe(self._site)
 
+    async def fetch(self, first_time=True):
         dts = await check_recent_site(self._site)
         dts.sort(reverse=True)
 
         sweep = None
         idt = 0
 
+        if self._ingest == 'stream':
+            # Get the sweep out of the volume that's still coming in, if it's gotten that far. Otherwise, fall back
+            # to the most recent complete volume, but only if we haven't sent anything yet.
+            sweep = await self._fetch_stream(dts[0])
+            if sweep is None and not first_time:
+                raise NoNewDataError(self.id)
+
+        elif self._ingest == 'progressive':
+            sweep = await self._fetch_progressive(dts[0])
+            if sweep is not None:
+                sweep['handler'] = self.id
+                return sweep
+            elif not first_time:
+                raise NoNewDataError(self.id)
+
         while sweep is None:
             fetch_dt = dts[idt]
             if first_time:
@@ -112,68 +321,421 @@ class Level2Handler(DataHandler):
                     break
 
             try:
-                rv = await RadarVolume.fetch(self._site, fetch_dt)
+                rv = await volume_store().get_volume(self._site, fetch_dt, self._field, self._elev)
             except (ValueError, KeyError) as exc:
                 print(exc)
             else:
                 sweep_obj = rv.get_sweep(self._field, self._elev)
+                if sweep_obj is not None and sweep_obj.is_aliased():
+                    await rv.dealias([ sweep_obj ])
 
                 try:
-                    sweep = sweep_obj.to_json()
+                    sweep = sweep_obj.to_json(encoding=self._encoding, lod=self._lod)
                 except AttributeError:
                     _logger.info("Rejecting volume: sweep not present")
                     sweep = None
                 else:
+                    volume_store().resize(self._site, fetch_dt)
                     if not sweep_obj.is_complete():
                         dazim = round(sweep_obj._dazim, 1)
-                        _logger.info(f"Rejecting volume: sweep incomplete (dazim = {dazim}, n_rays = {sweep_obj._data.shape[0]})")
+                        _logger.info(f"Rejecting volume: sweep incomplete (dazim = {dazim}, n_rays = {sweep_obj.n_rays})")
                         sweep = None
                     else:
-                        self._radar_vols.append(rv)
+                        self._last_vol = rv
 
             idt += 1
 
+        if self._ingest == 'volume' and first_time:
+            prefetcher().record(self._site, self._field, self._elev, fetch_dt)
+
         if self._last_dt_sent is not None and sweep['entities'][0]['valid'] <= self._last_dt_sent:
             raise NoNewDataError(self.id)
 
+        # Only once per new sweep, so the neighbors aren't tried again on every poll
+        if self._ingest == 'volume' and self._last_vol is not None:
+            prefetcher().predict(self._site, self._field, self._elev, fetch_dt, self._last_vol)
+
         self._last_dt_sent = sweep['entities'][0]['valid']
+        self._progress_sweep = None
+        self._n_rays_sent = None
 
-        _logger.debug(f"Number of radar volumes: {len(self._radar_vols)}")
+        _logger.debug(f"Number of radar volumes: {len(volume_store())} ({volume_store().n_bytes} bytes)")
         sweep['handler'] = self.id
         return sweep
        
-    def post_fetch(self):
-        self._cache_volumes()
+    def cache_writes(self):
+        if self._last_vol is None:
+            return []
+        return [ (swp.cache_key(), swp.cache) for swp in self._last_vol.cacheable_sweeps() ]
+
+    def snapshot(self):
+        # Somebody joining partway through a sweep needs everything sent so far, not just the last few rays
+        if self._progress_sweep is None:
+            return None
+
+        sweep = self._progress_sweep.to_json(encoding=self._encoding, ray_start=0)
+        sweep['partial'] = True
+        sweep['handler'] = self.id
+        return sweep
 
     def data_check_intv(self):
-        return 60
+        if self._ingest == 'volume':
+            return SiteIndex.get(self._site).seconds_to_check()
+        return RadarVolumeStream.poll_intv
+
+    async def _fetch_stream(self, dt):
+        stream = RadarVolumeStream.get(self._site, dt)
+        sweep_obj = stream.get_sweep(self._field, self._elev)
+        if sweep_obj is None:
+            return None
 
-    def _cache_volumes(self):
-        for rv in self._radar_vols:
-            rv.cache()
+        if sweep_obj.is_aliased():
+            await stream.volume.dealias([ sweep_obj ])
+        return sweep_obj.to_json(encoding=self._encoding, lod=self._lod)
+
+    async def _fetch_progressive(self, dt):
+        # The first time a sweep shows up, send all of it that's in so far, then only the rays that are new since the
+        # last message. Velocity can't be dealiased until the whole sweep is in, so it goes out in one piece.
+        stream = RadarVolumeStream.get(self._site, dt)
+        stream.progressive = True
+        sweep_obj = stream.volume.get_sweep(self._field, self._elev)
+        if sweep_obj is None:
+            return None
 
-    def _load_cache(self, dt):
-        sweep = self._cache.load_cache(dt)
+        if sweep_obj.is_aliased():
+            if not sweep_obj.is_complete():
+                return None
+            await stream.volume.dealias([ sweep_obj ])
+
+        valid = sweep_obj.timestamp.strftime("%Y-%m-%d %H:%M:%S UTC")
+        if self._last_dt_sent is not None and valid < self._last_dt_sent:
+            return None
+
+        if valid == self._last_dt_sent:
+            if self._n_rays_sent is None or sweep_obj.n_rays <= self._n_rays_sent:
+                return None
+            ray_start = self._n_rays_sent
+        else:
+            ray_start = 0
+
+        sweep = sweep_obj.to_json(encoding=self._encoding, ray_start=ray_start)
+        sweep['partial'] = True
+
+        self._last_dt_sent = valid
+        self._progress_sweep = sweep_obj
+        self._n_rays_sent = None if sweep_obj.is_complete() else sweep_obj.n_rays
+
+        _logger.debug(f"Sending rays {ray_start}-{sweep_obj.n_rays} of {self.id} at {valid}")
         return sweep
 
+    def _load_cache(self, dt):
+        cached = sweep_cache().load_cache(self._site, self._field, self._elev, dt)
+        if cached is None:
+            return None
+
+        meta, data = cached
+        return RadarSweep.from_cache(self._site, meta, data).to_json(encoding=self._encoding, lod=self._lod)
+
+
+class VolumeStore(object):
+    # Process-wide store of decoded volumes, keyed by (site, volume time) and shared by every Level2Handler. Only the
+    # fields somebody is subscribed to are kept, and the least recently used volumes go once the store is over its
+    # memory budget.
+    def __init__(self, max_bytes=1024 ** 3, max_age=timedelta(hours=2)):
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+
+        self._vols = OrderedDict()
+        self._sizes = {}   # what each volume was counted as in _n_bytes
+        self._fetching = {}
+        self._fields = defaultdict(Counter)
+        self._n_bytes = 0
+
+    def subscribe(self, site, field):
+        self._fields[site][field] += 1
+
+    def unsubscribe(self, site, field):
+        self._fields[site][field] -= 1
+        if self._fields[site][field] <= 0:
+            del self._fields[site][field]
+
+    async def get_volume(self, site, dt, field, elev):
+        # The newest volume is usually still being written when it's downloaded, so a stored volume is only good enough
+        # if the sweep that's wanted is all there. Otherwise, the volume is downloaded again, and the new copy replaces
+        # the stored one if it got further.
+        key = (site, dt)
+        rv = self._vols.get(key)
+        if rv is not None and rv.has_sweep(field, elev):
+            self._vols.move_to_end(key)
+            return rv
+
+        if key not in self._fetching:
+            self._fetching[key] = asyncio.ensure_future(RadarVolume.fetch(site, dt))
+
+        fetch = self._fetching[key]
+        try:
+            rv_full = await asyncio.shield(fetch)
+        finally:
+            if fetch.done() and self._fetching.get(key) is fetch:
+                del self._fetching[key]
+
+        rv = self._vols.get(key)
+        if rv is not None and rv.has_sweep(field, elev):
+            return rv
+
+        keep = set(self._fields[site]) | { field }
+        if rv is not None:
+            keep |= rv.fields
+
+        rv_new = rv_full.keep_fields(keep)
+        if rv is not None and rv.has_field(field) and rv_new.n_complete <= rv.n_complete:
+            return rv
+
+        self._add(key, rv_new)
+        return rv_new
+
+    def resize(self, site, dt):
+        # Volumes grow after they're stored (pooled levels of detail, dealiasing), so whoever changes one says so here
+        key = (site, dt)
+        if key not in self._vols:
+            return
+
+        n_bytes = self._vols[key].nbytes
+        self._n_bytes += n_bytes - self._sizes[key]
+        self._sizes[key] = n_bytes
+        self._evict(key)
+
+    def _add(self, key, rv):
+        if key in self._vols:
+            self._remove(key)
+
+        self._vols[key] = rv
+        self._sizes[key] = rv.nbytes
+        self._n_bytes += self._sizes[key]
+        self._evict(key)
+
+    def _evict(self, keep_key):
+        too_old = datetime.utcnow() - self._max_age
+        for old_key in [ k for k, v in self._vols.items() if v.timestamp < too_old and k != keep_key ]:
+            self._remove(old_key)
+
+        while self._n_bytes > self._max_bytes and len(self._vols) > 1:
+            old_key = next(k for k in self._vols.keys() if k != keep_key)
+            self._remove(old_key)
+            _logger.debug(f"Evicting {old_key[0]} volume at {old_key[1].strftime('%H%M UTC')} from the volume store")
+
+    def _remove(self, key):
+        del self._vols[key]
+        self._n_bytes -= self._sizes.pop(key)
+
+    @property
+    def n_bytes(self):
+        return self._n_bytes
+
+    def __len__(self):
+        return len(self._vols)
+
+
+class Prefetcher(object):
+    # Gets sweeps downloaded, decoded and dealiased before anybody asks for them. Tilts in the warm set are fetched at
+    # startup and again whenever their site's index says a new volume is due. When somebody is watching a tilt, the
+    # tilts just above and below it and the other field (REF <-> VEL) at the same tilt get done too, since that's
+    # usually what they look at next. A hit is a viewer's first sweep having already been prefetched.
+    companion_fields = {'REF': 'VEL', 'VEL': 'REF'}
+    max_tracked = 4096
+    report_every = 50
+
+    def __init__(self, warm=None, adjacent=1, companions=True):
+        self._warm = defaultdict(set)
+        for site, field, elev in (warm or []):
+            self._warm[site].add((field, round(float(elev), 1)))
+
+        self._adjacent = adjacent
+        self._companions = companions
+
+        self._prefetched = OrderedDict()   # (site, field, elev, volume time) -> why it was prefetched
+        self._in_flight = set()
+        self._tasks = set()
+
+        self.n_prefetched = Counter()
+        self.n_failed = 0
+        self.n_requests = 0
+        self.n_hits = Counter()
+
+    def start(self):
+        for site, tilts in self._warm.items():
+            for field in set(field for field, elev in tilts):
+                volume_store().subscribe(site, field)
+            self._schedule_warm(site, 0)
+
+    def stop(self):
+        for site in self._warm.keys():
+            get_scheduler().cancel(('prefetch', site))
+        for task in self._tasks:
+            task.cancel()
+
+    def activated(self, site, field):
+        # The companion field has to be kept when the volume is first stored, or getting it later means another download
+        companion = self._companion(field)
+        if companion is not None:
+            volume_store().subscribe(site, companion)
+
+    def deactivated(self, site, field):
+        companion = self._companion(field)
+        if companion is not None:
+            volume_store().unsubscribe(site, companion)
+
+    def predict(self, site, field, elev, dt, rv):
+        elev = round(float(elev), 1)
+        wanted = []
+        if self._adjacent > 0:
+            elevs = rv.elevations(field)
+            if elev in elevs:
+                iel = elevs.index(elev)
+                wanted += [ (field, el, 'adjacent') for el in elevs[max(iel - self._adjacent, 0):iel] ]
+                wanted += [ (field, el, 'adjacent') for el in elevs[(iel + 1):(iel + 1 + self._adjacent)] ]
+
+        companion = self._companion(field)
+        if companion is not None:
+            wanted.append((companion, elev, 'companion'))
+
+        for pf_field, pf_elev, reason in wanted:
+            if (site, pf_field, pf_elev, dt) not in self._prefetched:
+                task = asyncio.ensure_future(self._prefetch(site, dt, pf_field, pf_elev, reason))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def record(self, site, field, elev, dt):
+        self.n_requests += 1
+        reason = self._prefetched.get((site, field, round(float(elev), 1), dt))
+        if reason is not None:
+            self.n_hits[reason] += 1
+
+        if self.n_requests % Prefetcher.report_every == 0:
+            _logger.info(f"Prefetch stats: {self.stats()}")
+
+    def stats(self):
+        n_hits = sum(self.n_hits.values())
+        return {'n_warm': sum(len(tilts) for tilts in self._warm.values()), 'n_prefetched': dict(self.n_prefetched),
+                'n_failed': self.n_failed, 'n_requests': self.n_requests, 'n_hits': dict(self.n_hits),
+                'hit_rate': n_hits / max(self.n_requests, 1)}
+
+    def _companion(self, field):
+        return Prefetcher.companion_fields.get(field) if self._companions else None
+
+    def _schedule_warm(self, site, delay):
+        async def refresh():
+            await self._refresh_warm(site)
+
+        get_scheduler().schedule(('prefetch', site), delay, refresh)
+
+    async def _refresh_warm(self, site):
+        # Same as the handlers: take the newest volume, or the one before it if the tilt isn't all there yet
+        try:
+            dts = sorted(await check_recent_site(site), reverse=True)
+            for field, elev in self._warm[site]:
+                for dt in dts[:2]:
+                    if await self._prefetch(site, dt, field, elev, 'warm'):
+                        break
+        except Exception as exc:
+            _logger.error(f"Error refreshing warm radar data for {site}: {exc}")
+        finally:
+            self._schedule_warm(site, SiteIndex.get(site).seconds_to_check())
+
+    async def _prefetch(self, site, dt, field, elev, reason):
+        key = (site, field, elev, dt)
+        if key in self._prefetched or key in self._in_flight:
+            return True
+
+        self._in_flight.add(key)
+        try:
+            rv = await volume_store().get_volume(site, dt, field, elev)
+            sweep_obj = rv.get_sweep(field, elev)
+            if sweep_obj is None or not sweep_obj.is_complete():
+                return False
+
+            if sweep_obj.is_aliased():
+                await rv.dealias([ sweep_obj ])
+                volume_store().resize(site, dt)
+        except Exception as exc:
+            self.n_failed += 1
+            _logger.info(f"Couldn't prefetch {site} {field} {elev} at {dt.strftime('%H%M UTC')}: {exc}")
+            return False
+        finally:
+            self._in_flight.discard(key)
+
+        self._prefetched[key] = reason
+        self.n_prefetched[reason] += 1
+        while len(self._prefetched) > Prefetcher.max_tracked:
+            self._prefetched.popitem(last=False)
+
+        _logger.debug(f"Prefetched {site} {field} {elev} at {dt.strftime('%H%M UTC')} ({reason})")
+        return True
+
 
 class RadarVolume(object):
-    def __init__(self, sweeps):
+    def __init__(self, sweeps, raw=None):
         self._sweeps = sweeps
+        self._raw = raw
+        self._dealiasing = {}
+
+        self._index = {}
+        for swp in sweeps:
+            if swp.has_data():
+                self._index[(RadarSweep._cache_fields[swp.field], round(float(swp.elevation), 1))] = swp
 
     def get_sweep(self, field, elev):
-        sweep = None
-        for swp in self._sweeps:
-            swp_field = RadarSweep._cache_fields[swp.field]
-            swp_elev = round(swp.elevation, 1)
-            if field == swp_field and elev == swp_elev and swp.has_data():
-                sweep = swp
-        return sweep
+        return self._index.get((field, round(float(elev), 1)))
 
-    def cache(self):
-        for swp in self._sweeps:
-            if swp.is_complete() and swp.has_data():
-                swp.cache()
+    @property
+    def fields(self):
+        return set(field for field, elev in self._index.keys())
+
+    def elevations(self, field):
+        return sorted(elev for fld, elev in self._index.keys() if fld == field)
+
+    def has_field(self, field):
+        return field in self.fields
+
+    def has_sweep(self, field, elev):
+        swp = self.get_sweep(field, elev)
+        return swp is not None and swp.is_complete()
+
+    @property
+    def n_complete(self):
+        return len([ swp for swp in self._sweeps if swp.is_complete() ])
+
+    def keep_fields(self, fields):
+        sweeps = [ swp for swp in self._sweeps if RadarSweep._cache_fields[swp.field] in fields ]
+
+        # The raw volume is only needed to dealias velocity
+        raw = self._raw if 'VEL' in fields else None
+        return RadarVolume(sweeps, raw=raw)
+
+    @property
+    def nbytes(self):
+        return sum(swp.nbytes for swp in self._sweeps) + (len(self._raw) if self._raw is not None else 0)
+
+    async def dealias(self, sweeps):
+        # Velocity is dealiased one sweep at a time and only when somebody asks for it. Requests for the same sweep
+        # share one decode, and requests for different sweeps run in parallel in the decode pool.
+        async def dealias_sweep(swp):
+            if swp.sweep_index not in self._dealiasing:
+                self._dealiasing[swp.sweep_index] = asyncio.ensure_future(
+                    get_decode_pool().run(_dealias_sweep, self._raw, swp.sweep_index)
+                )
+
+            try:
+                swp.set_dealiased(await asyncio.shield(self._dealiasing[swp.sweep_index]))
+            except Exception:
+                del self._dealiasing[swp.sweep_index]
+                raise
+
+        await asyncio.gather(*[ dealias_sweep(swp) for swp in sweeps if swp.is_aliased() ])
+
+    def cacheable_sweeps(self):
+        return [ swp for swp in self._sweeps
+                 if not swp.is_cached and swp.is_complete() and swp.has_data() and not swp.is_aliased() ]
 
     @property
     def timestamp(self):
@@ -187,56 +749,355 @@ class RadarVolume(object):
             url = f"{_url_base}/{site}/{site}_{dt.strftime('%Y%m%d_%H%M')}"
 
         _logger.debug(f"Downloading radar volume for {site} at {dt.strftime('%d %b %Y %H%M UTC')}")
-        bio = BytesIO()
-        bio.write(await download(url))
-        bio.seek(0)
+        raw = await download(url)
+
+        sweep_args = await get_decode_pool().run(_decode_volume, raw)
+        sweeps = [ RadarSweep(site, *args) for args in sweep_args ]
+        return cls(sweeps, raw=raw)
+
+
+class RadarVolumeStream(object):
+    # Incrementally downloads a volume that's still being written, using range requests to get only the new bytes.
+    # PyART can only decode the whole file so far, so that's only done when the new LDM records finish a sweep (which
+    # just takes decompressing the new records to find out), or on every new record if somebody wants rays as they
+    # come in (progressive ingest). Sweeps become available as soon as they're complete, so the lowest tilt goes out
+    # minutes before the volume is done. A site's stream is only kept while some handler that streams it is running.
+    poll_intv = 10
+    idle_timeout = 180
+    _streams = {}
+    _n_subscribers = Counter()
+
+    def __init__(self, site, dt, local=False):
+        self.site = site
+        self.dt = dt
+        self.volume = RadarVolume([])
 
-        rfile = read_nexrad_archive(bio)
-        rfile_dealias = dealias_unwrap_phase(rfile)
-        dt = datetime.strptime(rfile.time['units'], 'seconds since %Y-%m-%dT%H:%M:%SZ')
+        if local:
+            self._url = f"http://127.0.0.1:8000/data/l2raw/{site}{dt.strftime('%Y%m%d_%H%M%S')}_V06"
+        else:
+            self._url = f"{_url_base}/{site}/{site}_{dt.strftime('%Y%m%d_%H%M')}"
 
+        self._buf = bytearray()
+        self._scanned_end = volume_header_size
+        self._decoded_end = 0
+        self._task = None
+        self.progressive = False
+
+    @classmethod
+    def get(cls, site, dt, local=False):
+        # One stream per site, for the newest volume. Starting a newer one retires the old one. Nothing gets started
+        # for a site nobody is subscribed to anymore (a fetch that finishes after its handler stopped).
+        stream = cls._streams.get(site)
+        if stream is None or stream.dt < dt:
+            if stream is not None:
+                stream.stop()
+
+            stream = cls(site, dt, local=local)
+            if cls._n_subscribers[site] > 0:
+                stream.start()
+                cls._streams[site] = stream
+        return stream
+
+    @classmethod
+    def subscribe(cls, site):
+        cls._n_subscribers[site] += 1
+
+    @classmethod
+    def unsubscribe(cls, site):
+        cls._n_subscribers[site] -= 1
+        if cls._n_subscribers[site] <= 0:
+            del cls._n_subscribers[site]
+            stream = cls._streams.pop(site, None)
+            if stream is not None:
+                stream.stop()
+
+    def get_sweep(self, field, elev):
+        sweep = self.volume.get_sweep(field, elev)
+        if sweep is None or not sweep.is_complete():
+            return None
+        return sweep
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        idle = 0
+        while idle < RadarVolumeStream.idle_timeout:
+            try:
+                chunk = await download_range(self._url, start=len(self._buf))
+            except Exception as exc:
+                _logger.error(f"Error streaming {self.site} volume: {exc}")
+                chunk = b""
+
+            self._buf.extend(chunk)
+            end = complete_records(self._buf, start=self._scanned_end)
+
+            if end > self._scanned_end:
+                idle = 0
+                n_ends = await self._sweep_ends(end)
+                self._scanned_end = end
+                if n_ends > 0 or self.progressive:
+                    await self._decode(end)
+            else:
+                idle += RadarVolumeStream.poll_intv
+
+            await asyncio.sleep(RadarVolumeStream.poll_intv)
+
+        # The volume might have stopped partway through a sweep
+        if self._scanned_end > self._decoded_end:
+            await self._decode(self._scanned_end)
+
+        # The volume has its own copy of the raw data, so the download buffer isn't needed anymore
+        self._buf = bytearray()
+
+        _logger.debug(f"Done streaming {self.site} volume at {self.dt.strftime('%H%M UTC')}")
+
+    async def _sweep_ends(self, end):
+        try:
+            return await get_decode_pool().run(sweep_ends, bytes(self._buf[self._scanned_end:end]))
+        except Exception as exc:
+            # Decode anyway, so a bad record doesn't hold up the rest of the volume
+            _logger.error(f"Error scanning {self.site} volume records: {exc}")
+            return 1
+
+    async def _decode(self, end):
+        raw = bytes(self._buf[:end])
+        try:
+            sweep_args = await get_decode_pool().run(_decode_volume, raw)
+        except Exception as exc:
+            _logger.info(f"Can't decode partial {self.site} volume yet: {exc}")
+            return
+
+        # Keep any sweeps that were already dealiased instead of replacing them with aliased copies.
+        old_sweeps = { (swp.field, swp.sweep_index): swp for swp in self.volume._sweeps }
         sweeps = []
-        for field in rfile.fields.keys():
-            for ie, elv in enumerate(rfile.fixed_angle['data']):
-                istart, iend = rfile.get_start_end(ie)
-                azimuths = rfile.get_azimuth(ie)
-                ranges = rfile.range['data']
-
-                nyquist = rfile.get_nyquist_vel(ie)
-                if field == 'velocity' and nyquist < 10:
+        for args in sweep_args:
+            swp = RadarSweep(self.site, *args)
+            old_swp = old_sweeps.get((swp.field, swp.sweep_index))
+            if old_swp is not None and old_swp.is_complete() and not old_swp.is_aliased():
+                swp = old_swp
+            sweeps.append(swp)
+
+        self.volume = RadarVolume(sweeps, raw=raw)
+        self._decoded_end = end
+
+        n_complete = len([ swp for swp in sweeps if swp.is_complete() ])
+        _logger.debug(f"Streamed {end} bytes of {self.site} volume, {n_complete} complete sweeps")
+
+
+class LevelOfDetail(object):
+    # Cuts a sweep down to what a client can actually display: out to max_range (km), within an azimuth sector
+    # (clockwise from the first azimuth to the second, in degrees), and pooled over blocks of decimate = (rays, gates).
+    # Alternatively, resolution (km per screen pixel) picks the decimation so a pooled gate is about a pixel across.
+    # Reflectivity and spectrum width keep the maximum in each block, velocity the value farthest from zero, and
+    # everything else the mean.
+    #
+    # Every distinct level of detail is another handler and another pooled copy of the sweep, so the parameters are
+    # snapped to a few values: the range up to a multiple of range_step, the sector out to multiples of sector_step,
+    # the resolution down to a power of 2, and the decimation factors to at most max_decimate.
+    _pooling = {'REF': 'max', 'SPW': 'max', 'VEL': 'absmax', 'ZDR': 'mean', 'CCR': 'mean', 'KDP': 'mean'}
+    range_step = 25.
+    sector_step = 5.
+    max_decimate = 16
+    resolution_limits = (0.25, 64.)
+
+    def __init__(self, max_range=None, sector=None, decimate=None, resolution=None):
+        if decimate is not None and resolution is not None:
+            raise ValueError("Give either decimate or resolution, not both")
+        if isinstance(decimate, int):
+            decimate = (decimate, decimate)
+
+        if max_range is not None:
+            if max_range <= 0:
+                raise ValueError("max_range must be positive")
+            max_range = float(np.ceil(max_range / LevelOfDetail.range_step) * LevelOfDetail.range_step)
+
+        if sector is not None:
+            if len(sector) != 2:
+                raise ValueError("sector must be a pair of azimuths")
+            step = LevelOfDetail.sector_step
+            sector = (float(np.floor(sector[0] / step) * step % 360), float(np.ceil(sector[1] / step) * step % 360))
+
+        if decimate is not None:
+            if len(decimate) != 2 or any(int(f) < 1 for f in decimate):
+                raise ValueError("Decimation factors must be at least 1")
+            decimate = tuple(min(int(f), LevelOfDetail.max_decimate) for f in decimate)
+
+        if resolution is not None:
+            if resolution <= 0:
+                raise ValueError("resolution must be positive")
+            res_min, res_max = LevelOfDetail.resolution_limits
+            resolution = float(np.clip(2 ** np.floor(np.log2(resolution)), res_min, res_max))
+
+        self.max_range = max_range
+        self.sector = sector
+        self.decimate = decimate
+        self.resolution = resolution
+
+    def is_full(self):
+        return all(p is None for p in [ self.max_range, self.sector, self.decimate, self.resolution ])
+
+    @property
+    def id(self):
+        parts = []
+        if self.max_range is not None:
+            parts.append(f"r{self.max_range:g}")
+        if self.sector is not None:
+            parts.append(f"s{self.sector[0]:g}-{self.sector[1]:g}")
+        if self.decimate is not None:
+            parts.append(f"d{self.decimate[0]}x{self.decimate[1]}")
+        if self.resolution is not None:
+            parts.append(f"px{self.resolution:g}")
+        return ".".join(parts)
+
+    def apply(self, sweep):
+        codes = sweep._codes
+        st_az, st_rn, dazim, drng = sweep._st_az, sweep._st_rn, sweep._dazim, sweep._drng
+        n_rays, n_gates = codes.shape
+
+        if self.sector is not None:
+            az_start, az_end = self.sector
+            width = (az_end - az_start) % 360 or 360
+            ray_az = (st_az + np.arange(n_rays) * dazim - az_start) % 360
+            in_sector = np.nonzero(ray_az <= width)[0]
+            if len(in_sector) > 0:
+                # Start at the first ray in the sector, even if the sector wraps around the end of the sweep
+                i_first = in_sector[np.argmin(ray_az[in_sector])]
+                n_sector = len(in_sector)
+                codes = codes[(i_first + np.arange(n_sector)) % n_rays]
+                st_az = (st_az + i_first * dazim) % 360
+            else:
+                codes = codes[:0]
+
+        if self.max_range is not None:
+            n_gates = int(np.clip(np.floor((self.max_range * 1000. - st_rn) / drng) + 1, 0, n_gates))
+            codes = codes[:, :n_gates]
+
+        if self.decimate is not None:
+            ray_factor, gate_factor = self.decimate
+        elif self.resolution is not None:
+            # A pixel at the far end of the (possibly shortened) sweep covers this many rays and gates
+            far_range = st_rn + codes.shape[1] * drng
+            ray_factor = int(max(self.resolution * 1000. / (far_range * np.radians(dazim)), 1))
+            gate_factor = int(max(self.resolution * 1000. / drng, 1))
+        else:
+            ray_factor, gate_factor = 1, 1
+
+        if ray_factor > 1 or gate_factor > 1:
+            how = LevelOfDetail._pooling[RadarSweep._cache_fields[sweep.field]]
+            _, _, offset = RadarSweep._quant_params[RadarSweep._cache_fields[sweep.field]]
+            codes = _pool(codes, ray_factor, gate_factor, how, offset)
+            st_az += (ray_factor - 1) * dazim / 2
+            st_rn += (gate_factor - 1) * drng / 2
+            dazim *= ray_factor
+            drng *= gate_factor
+
+        return np.ascontiguousarray(codes), st_az, st_rn, dazim, drng
+
+
+def _pool(codes, ray_factor, gate_factor, how, zero_code):
+    # Pools blocks of quantized codes (0 is missing, so it never wins and doesn't count toward a mean). The edges are
+    # padded out to a whole number of blocks with missing data.
+    n_rays, n_gates = codes.shape
+    pad_rays = (-n_rays) % ray_factor
+    pad_gates = (-n_gates) % gate_factor
+    padded = np.pad(codes, ((0, pad_rays), (0, pad_gates)), mode='constant')
+
+    shape = (padded.shape[0] // ray_factor, ray_factor, padded.shape[1] // gate_factor, gate_factor)
+    blocks = padded.reshape(shape).transpose(0, 2, 1, 3).reshape(shape[0], shape[2], -1)
+
+    if how == 'max':
+        return blocks.max(axis=-1)
+    elif how == 'absmax':
+        distance = np.where(blocks == 0, -1, np.abs(blocks.astype(np.int32) - int(zero_code)))
+        return np.take_along_axis(blocks, distance.argmax(axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+    else:
+        n_valid = np.count_nonzero(blocks, axis=-1)
+        total = blocks.sum(axis=-1, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n_valid > 0, np.round(total / n_valid), 0)
+        return mean.astype(codes.dtype)
+
+
+def quantize(field, data):
+    dtype, scale, offset = RadarSweep._quant_params[field]
+    codes = np.clip(np.round(data * scale + offset), 1, np.iinfo(dtype).max)
+    return np.ma.filled(codes, 0).astype(dtype)
+
+
+# Runs in a decode pool worker. Returns the RadarSweep arguments (minus the site) for each sweep, with the data
+# quantized to native Level II widths so there's less to send back to the event loop. Velocity comes back aliased;
+# see _dealias_sweep().
+def _decode_volume(raw):
+    rfile = read_nexrad_archive(BytesIO(raw))
+    dt = datetime.strptime(rfile.time['units'], 'seconds since %Y-%m-%dT%H:%M:%SZ')
+
+    sweeps = []
+    for field in rfile.fields.keys():
+        if field not in RadarSweep._cache_fields:
+            continue
+
+        for ie, elv in enumerate(rfile.fixed_angle['data']):
+            istart, iend = rfile.get_start_end(ie)
+            azimuths = rfile.get_azimuth(ie)
+            ranges = rfile.range['data']
+
+            nyquist = rfile.get_nyquist_vel(ie)
+            if field == 'velocity' and nyquist < 10:
+                continue
+            elif field != 'velocity' and len(sweeps) > 0 and sweeps[-1][2] == elv and sweeps[-1][1] == field:
+                # Check to see if this is a "duplicate" sweep
+                if nyquist > 10:
+                    # Assume this is the short-range sweep and ignore it
                     continue
-                elif field != 'velocity' and len(sweeps) > 0 and sweeps[-1].elevation == elv and sweeps[-1].field == field:
-                    # Check to see if this is a "duplicate" sweep
-                    if nyquist > 10:
-                        # Assume this is the short-range sweep and ignore it
-                        continue
-                    else:
-                        # Assume that somehow the short-range sweep got put in the file
-                        # first and take it out. I don't think this should ever happen.
-                        sweeps.pop()
+                else:
+                    # Assume that somehow the short-range sweep got put in the file
+                    # first and take it out. I don't think this should ever happen.
+                    sweeps.pop()
 
-                saz = azimuths[0]
-                eaz = azimuths[-1] if azimuths[-1] > azimuths[0] else azimuths[-1] + 360
-                dazim = round((eaz - saz) / len(azimuths), 1)
+            saz = azimuths[0]
+            eaz = azimuths[-1] if azimuths[-1] > azimuths[0] else azimuths[-1] + 360
+            dazim = round((eaz - saz) / len(azimuths), 1)
 
-                dt_sweep = dt + timedelta(seconds=rfile.time['data'][istart])
+            dt_sweep = dt + timedelta(seconds=rfile.time['data'][istart])
+
+            field_data = rfile.get_field(ie, field)
+
+            sweeps.append((dt_sweep, field, float(elv), float(azimuths[0]), float(ranges[0]), float(dazim), 250,
+                           quantize(RadarSweep._cache_fields[field], field_data), ie, field == 'velocity'))
+    return sweeps
 
-                if field == 'velocity':
-                    field_data = rfile_dealias['data'][istart:(iend + 1)]
-                else:
-                    field_data = rfile.get_field(ie, field)
 
-                rs = RadarSweep(site, dt_sweep, field, elv, 
-                                azimuths[0], float(ranges[0]), dazim, 250, field_data)
-                sweeps.append(rs)
-        return cls(sweeps)
+# Runs in a decode pool worker. Reads only the one scan out of the volume and dealiases it.
+def _dealias_sweep(raw, sweep_index):
+    rfile = read_nexrad_archive(BytesIO(raw), scans=[ sweep_index ], include_fields=[ 'velocity' ])
+    rfile_dealias = dealias_unwrap_phase(rfile)
+    return quantize('VEL', rfile_dealias['data'])
 
 
 class RadarSweep(object):
     _cache_fields = {'reflectivity': 'REF', 'velocity': 'VEL', 'spectrum_width': 'SPW', 
                      'cross_correlation_ratio': 'CCR', 'differential_phase': 'KDP', 'differential_reflectivity': 'ZDR'}
 
-    def __init__(self, site, dt, field, elevation, start_azimuth, start_range, dazim, drng, data):
+    # Sweeps are stored as round(value * scale + offset), with 0 reserved for missing data, like Level II does.
+    _quant_params = {'REF': ('<u1', 2., 66.), 'VEL': ('<u2', 10., 2000.), 'SPW': ('<u1', 2., 129.),
+                     'ZDR': ('<u1', 16., 128.), 'CCR': ('<u1', 300., -60.5), 'KDP': ('<u2', 2.8361, 2.)}
+    _encodings = ['float32', 'quantized']
+
+    # Pooled copies kept for different levels of detail, oldest dropped first
+    max_lods = 4
+
+    __slots__ = ['site', 'timestamp', 'field', 'elevation', '_st_az', '_st_rn', '_dazim', '_drng', '_codes',
+                 'sweep_index', '_aliased', 'is_cached', '_lods']
+
+    def __init__(self, site, dt, field, elevation, start_azimuth, start_range, dazim, drng, codes, sweep_index=None,
+                 aliased=False):
         ctr_azim = dazim / 2
 
         self.site = site
@@ -247,47 +1108,104 @@ class RadarSweep(object):
         self._st_rn = start_range
         self._dazim = dazim
         self._drng = drng
-        self._data = data
+        self._codes = codes
+        self.sweep_index = sweep_index
+        self._aliased = aliased
+        self.is_cached = False
+        self._lods = {}
 
-        field_str = RadarSweep._cache_fields[self.field]
-        self._cache = Cache(_cache_fname(Level2Handler._cache_dir, self.site, RadarSweep._cache_fields[self.field], self.elevation))
+    @property
+    def n_rays(self):
+        return self._codes.shape[0]
+
+    @property
+    def nbytes(self):
+        return self._codes.nbytes + sum(lod[0].nbytes for lod in self._lods.values())
+
+    @property
+    def data(self):
+        _, scale, offset = RadarSweep._quant_params[RadarSweep._cache_fields[self.field]]
+        values = (self._codes.astype(np.float32) - offset) / scale
+        return np.ma.MaskedArray(values, mask=(self._codes == 0))
 
     def is_complete(self):
-        n_rays = self._data.shape[0]
+        n_rays = self.n_rays
         return (self._dazim == 0.5 and n_rays == 720) or (self._dazim == 1.0 and n_rays == 360)
 
-    def has_data(self):
-        return (~self._data.mask).sum() > 10
+    def is_aliased(self):
+        return self._aliased
 
-    def to_json(self):
-        data_filled = list(np.ma.filled(self._data, -99.).ravel())
-        data_packed = struct.pack("%df" % len(data_filled), *data_filled)
+    def set_dealiased(self, codes):
+        self._codes = codes
+        self._aliased = False
+        self._lods = {}
+
+    def has_data(self):
+        return np.count_nonzero(self._codes) > 10
+
+    def to_json(self, encoding='float32', ray_start=None, lod=None):
+        # With ray_start, only the rays from there on are included (for sending a sweep as it comes in)
+        codes = self._codes if ray_start is None else self._codes[ray_start:]
+        st_az, st_rn, dazim, drng = self._st_az, self._st_rn, self._dazim, self._drng
+        if lod is not None:
+            if lod.id not in self._lods:
+                while len(self._lods) >= RadarSweep.max_lods:
+                    del self._lods[next(iter(self._lods))]
+                self._lods[lod.id] = lod.apply(self)
+            codes, st_az, st_rn, dazim, drng = self._lods[lod.id]
+
+        dtype, scale, offset = RadarSweep._quant_params[RadarSweep._cache_fields[self.field]]
+        if encoding == 'quantized':
+            data_packed = codes.astype(dtype, copy=False)
+            data_encoding = {'encoding': np.dtype(dtype).name, 'scale': scale, 'offset': offset, 'missing': 0}
+        else:
+            values = np.ma.MaskedArray((codes.astype(np.float32) - offset) / scale, mask=(codes == 0))
+            data_packed = np.ma.filled(values, -99.).astype('<f4', copy=False)
+            data_encoding = {'encoding': 'float32', 'missing': -99.}
 
-        for st in radar_info():
-            if st['id'] == self.site:
-                site = st
-                break
+        site = radars()[self.site]
 
         rs_json = {'site': self.site, 'field': self.field.title(), 'elevation': "%f" % self.elevation}
 
-        radar_entity = {'st_azimuth': self._st_az, 'st_range': self._st_rn, 'dazim':self._dazim, 'drng':self._drng}
+        radar_entity = {'st_azimuth': st_az, 'st_range': st_rn, 'dazim': dazim, 'drng': drng}
         radar_entity['site_latitude'] = site['latitude']
         radar_entity['site_longitude'] = site['longitude']
 
         radar_entity['valid'] = self.timestamp.strftime("%Y-%m-%d %H:%M:%S UTC")
         radar_entity['expires'] = (self.timestamp + timedelta(minutes=15)).strftime("%Y-%m-%d %H:%M:%S UTC")
-        radar_entity['n_rays'], radar_entity['n_gates'] = self._data.shape
-        base64_data = base64.encodebytes(data_packed).decode('ascii')
-        radar_entity['data'] = "".join(base64_data.split("\n"))
+        radar_entity['n_rays'], radar_entity['n_gates'] = codes.shape
+        if ray_start is not None:
+            radar_entity['ray_start'] = ray_start
+            radar_entity['complete'] = self.is_complete()
+        radar_entity.update(data_encoding)
+        radar_entity['data'] = data_packed.ravel()
 
         rs_json['entities'] = [radar_entity]
         return rs_json
         
+    @classmethod
+    def from_cache(cls, site, meta, codes):
+        # The codes are memory-mapped. Older cache entries hold floats with NaN for missing data.
+        dt = datetime.strptime(meta['timestamp'], "%Y-%m-%d %H:%M:%S")
+        if codes.dtype.kind == 'f':
+            codes = quantize(RadarSweep._cache_fields[meta['field']], np.ma.masked_invalid(codes))
+        swp = cls(site, dt, meta['field'], meta['elevation'], meta['st_azimuth'], meta['st_range'], meta['dazim'],
+                  meta['drng'], codes)
+        swp.is_cached = True
+        return swp
+
+    def cache_key(self):
+        return ('level2radar', self.site, self.field, round(float(self.elevation), 1), self.timestamp)
+
     def cache(self):
-        if not self._cache.is_cached(self.timestamp):
-            self._cache.cache(self.to_json(), self.timestamp)
+        field_str = RadarSweep._cache_fields[self.field]
+        if not sweep_cache().is_cached(self.site, field_str, self.elevation, self.timestamp):
+            meta = {'timestamp': self.timestamp.strftime("%Y-%m-%d %H:%M:%S"), 'field': self.field,
+                    'elevation': float(self.elevation), 'st_azimuth': float(self._st_az), 'st_range': float(self._st_rn),
+                    'dazim': float(self._dazim), 'drng': self._drng}
+            sweep_cache().cache(self.site, field_str, self.elevation, self.timestamp, meta, self._codes)
 
-        self._data = None
+        self.is_cached = True
 
 if __name__ == "__main__":
     check_recent()
@@ -1,30 +1,82 @@
 
+import numpy as np
 from bs4 import BeautifulSoup
 
 from datetime import datetime, timedelta
 import pytz
 import zipfile
-import zlib
-import base64
-import struct
 import json
 import urllib.request as urlreq
 import os
 import warnings
 from collections import defaultdict
-from math import exp, log, floor
+from functools import partial
+from math import floor
 import logging
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
 from metr_stream.handlers.handler import DataHandler
 from metr_stream.utils.download import download
-from metr_stream.utils.static import get_static
+from metr_stream.utils.stations import mesonet
 from metr_stream.utils.errors import StaleDataError
 from metr_stream.utils.obs.mdf import MDF
 from metr_stream.utils.cache import Cache
 
 
+# Layout of one ob for clients that haven't asked for station tables: the same as struct.pack('5sfffffff', ...)
+_ob_dtype = np.dtype([ ('STID', 'S5') ] + [ (p, 'f4') for p in ['LAT', 'LON', 'PALT', 'TAIR', 'TDEW', 'WDIR', 'WSPD'] ],
+                     align=True)
+
+
+# Station tables only ever grow while the server is up, so an index into one stays valid for the whole session (and
+# any payload built against an older, shorter version of the table still decodes against the current one).
+_station_tables = {}
+
+def _station_table(network):
+    if network not in _station_tables:
+        _station_tables[network] = StationTable(network)
+    return _station_tables[network]
+
+
+class StationTable(object):
+    def __init__(self, network):
+        self.network = network
+        self._ids = []
+        self._lats = []
+        self._lons = []
+        self._index = {}
+        self._arrays = None
+
+    @property
+    def id(self):
+        return f"{self.network}.{len(self._ids)}"
+
+    def indices(self, stids, lats, lons):
+        idxs = np.empty(len(stids), dtype=np.uint32)
+        for iob, stid in enumerate(stids):
+            idx = self._index.get(stid)
+            if idx is None:
+                idx = self._index[stid] = len(self._ids)
+                self._ids.append(stid)
+                self._lats.append(lats[iob])
+                self._lons.append(lons[iob])
+                self._arrays = None
+            idxs[iob] = idx
+
+        idx_dtype = np.uint16 if len(self._ids) <= 65536 else np.uint32
+        return idxs.astype(idx_dtype)
+
+    def to_json(self):
+        if self._arrays is None:
+            self._arrays = {
+                'ids': np.array(self._ids, dtype='S5'),
+                'lat': np.array(self._lats, dtype=np.float32),
+                'lon': np.array(self._lons, dtype=np.float32),
+            }
+        return dict(id=self.id, network=self.network, **self._arrays)
+
+
 def _cache_fname(source, network):
     def fname(dt):
         return f"data/sfc/{source}_{network}_{dt.strftime('%Y%m%d%H%M')}.json"
@@ -34,39 +86,44 @@ def _cache_fname(source, network):
 def _parse_metar_mdf(mdf_txt):
     mdf = MDF.from_string(mdf_txt)
 
-    obs = []
-    for ob in mdf:
-        for param in ob.keys():
-            try:
-                if ob[param] < -990:
-                    ob[param] = float('nan')
-            except TypeError:
-                pass
-
-        ob['STID'] = ob['STID'].encode('utf-8')
-        ob_time = mdf.base_time + timedelta(minutes=ob['TIME'])
-        ob['TIME'] = ob_time.strftime("%Y%m%d_%H%M").encode('utf-8')
-        ob['WSPD'] *= 1.94  # Convert m/s to kts
-        obs.append(ob)
+    # Observations come back as columns: one array per parameter
+    obs = {}
+    for param in mdf.columns:
+        col = mdf[param]
+        if col.dtype.kind in 'if':
+            missing = col < -990
+            if missing.any():
+                col = np.where(missing, np.nan, col.astype(np.float64))
+        obs[param] = col
+
+    obs['STID'] = np.char.encode(obs['STID'], 'utf-8')
+    ob_times = np.datetime64(mdf.base_time, 'm') + obs['TIME'].astype('timedelta64[m]')
+    ob_times = np.datetime_as_string(ob_times, unit='m')
+    for char, repl in [ ('-', ''), (':', ''), ('T', '_') ]:
+        ob_times = np.char.replace(ob_times, char, repl)
+    obs['TIME'] = np.char.encode(ob_times, 'utf-8')
+    obs['WSPD'] = obs['WSPD'] * 1.94  # Convert m/s to kts
 
     return obs
 
 
 def _parse_meso_mdf(mdf_txt):
-    static = get_static('okmesonet.json')
+    stations = mesonet()
 
     obs = _parse_metar_mdf(mdf_txt)
-    for ob in obs:
-        relh = float(ob['RELH']) / 100
-        tair = float(ob['TAIR']) + 273.15
-        sat_vapr = 611 * exp(2.5e6 / 461.5 * (1 / 273.15 - 1 / tair))
-        tdew = 1. / (1. / 273.15 - 461.5 / 2.5e6 * log((sat_vapr * relh) / 611))
-        ob['TDEW'] = tdew - 273.15
 
-        ob['PALT'] = ob['PRES'] # Set PMSL to be the station presssure for now
+    relh = obs['RELH'] / 100.
+    tair = obs['TAIR'] + 273.15
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sat_vapr = 611 * np.exp(2.5e6 / 461.5 * (1 / 273.15 - 1 / tair))
+        tdew = 1. / (1. / 273.15 - 461.5 / 2.5e6 * np.log((sat_vapr * relh) / 611))
+    obs['TDEW'] = tdew - 273.15
+
+    obs['PALT'] = obs['PRES'] # Set PMSL to be the station presssure for now
 
-        ob['LAT'] = float(static[ob['STID'].decode('utf-8')]['LAT'])
-        ob['LON'] = float(static[ob['STID'].decode('utf-8')]['LON'])
+    stids = [ stid.decode('utf-8') for stid in obs['STID'] ]
+    obs['LAT'] = np.array([ stations.lats[stid] for stid in stids ])
+    obs['LON'] = np.array([ stations.lons[stid] for stid in stids ])
     return obs
 
 
@@ -115,27 +172,69 @@ _configs = {
 }
 
 
+_params = ['PALT', 'TAIR', 'TDEW', 'WDIR', 'WSPD']
+
+
+def _delta_entity(base, entity):
+    # Only the stations and parameters that changed since `base`. Stations that weren't in `base` get every parameter.
+    base_idx = base['station_idx']
+    new_idx = entity['station_idx']
+    n_stations = int(max(base_idx.max(initial=0), new_idx.max(initial=0))) + 1
+
+    in_base = np.zeros(n_stations, dtype=bool)
+    in_base[base_idx] = True
+    in_new = np.zeros(n_stations, dtype=bool)
+    in_new[new_idx] = True
+    added = ~in_base[new_idx]
+
+    data = {}
+    for param in entity['params']:
+        old = np.full(n_stations, np.nan, dtype=np.float32)
+        old[base_idx] = base['data'][param]
+        old = old[new_idx]
+        new = entity['data'][param]
+
+        changed = added | ~((old == new) | (np.isnan(old) & np.isnan(new)))
+        if changed.any():
+            data[param] = {'station_idx': new_idx[changed], 'values': new[changed]}
+
+    return {
+        'network': entity['network'],
+        'valid': entity['valid'],
+        'expires': entity['expires'],
+        'station_table': entity['station_table'],
+        'added': new_idx[added],
+        'removed': base_idx[~in_new[base_idx]],
+        'params': entity['params'],
+        'data': data,
+    }
+
+
 class ObsHandler(DataHandler):
-    def __init__(self, source):
+    features = ['station_tables']
+
+    def __init__(self, source, features=()):
         self._source = source
-        self._obs = None
+        self._snapshots = []
         self._cache = {cfg.name: Cache(_cache_fname(self._source, cfg.name)) for cfg in _configs[source]}
 
-        self.id = f"obs.{self._source}"
+        # Clients that never asked for station tables keep getting every ob packed inline, under the old id
+        self._station_tables = 'station_tables' in features
+        self.id = f"obs.{self._source}.tables" if self._station_tables else f"obs.{self._source}"
 
     async def fetch(self, first_time=True):
-        params = ['STID', 'LAT', 'LON', 'PALT', 'TAIR', 'TDEW', 'WDIR', 'WSPD']
-        def pack_ob(param_order, ob):
-            pack_fmt = '5sfffffff'
-            return struct.pack(pack_fmt, *[ob[p] for p in param_order])
-
         obs_dt = max(cfg.get_time() for cfg in _configs[self._source])
 
+        snapshots = []
         entities = []
         for config in _configs[self._source]:
-            obs_entity = self._cache[config.name].load_cache(obs_dt)
+            snapshot = self._cache[config.name].load_cache(obs_dt)
+
+            # Caches from before the columnar layout don't have the obs in them
+            if snapshot is not None and 'obs' not in snapshot:
+                snapshot = None
 
-            if obs_entity is None:
+            if snapshot is None:
                 network_obs = None
                 network_error = False
                 dcycle = 0
@@ -148,50 +247,105 @@ class ObsHandler(DataHandler):
 
                     url = cfg_dt.strftime(config.url_fmt)
 
-                    txt = (await download(url)).decode('utf-8')
+                    txt = (await download(url, conditional=True)).decode('utf-8')
                     try:
                         network_obs = config.parser(txt)
                     except:
                         dcycle += 1
 
                 if not network_error:
-                    obs_str = b"".join(pack_ob(params, ob) for ob in network_obs)
-                    base64_data = base64.encodebytes(obs_str).decode('ascii')
-
-                    obs_entity = {
+                    snapshot = {
                         'network': config.name,
                         'valid': obs_dt.strftime("%Y-%m-%d %H:%M:%S UTC"),
                         'expires': (obs_dt + timedelta(seconds=config.stale)).strftime("%Y-%m-%d %H:%M:%S UTC"),
-                        'params': params,
-                        'data': "".join(base64_data.split("\n")),
+                        'obs': {p: np.asarray(network_obs[p], dtype=('S5' if p == 'STID' else np.float32))
+                                for p in ['STID', 'LAT', 'LON'] + _params},
                     }
 
-            if obs_entity is not None:
-                entities.append(obs_entity)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+                entities.append(self._to_entity(snapshot))
 
         if len(entities) == 0:
-            self._obs = None
+            self._snapshots = []
             raise StaleDataError(f"obs.{self._source}")
 
+        self._snapshots = snapshots
+
         obs_json = {
             'source': self._source,
             'handler': self.id,
             'entities': entities,
         }
 
-        self._obs = obs_json
-
         return obs_json
 
+    def _to_entity(self, snapshot):
+        if not self._station_tables:
+            return self._to_packed_entity(snapshot)
+
+        # One contiguous array per parameter, and the stations as indices into the session's station table
+        network_obs = snapshot['obs']
+        table = _station_table(snapshot['network'])
+        stids = [ stid.decode('utf-8') for stid in network_obs['STID'] ]
+        station_idx = table.indices(stids, network_obs['LAT'], network_obs['LON'])
+
+        entity = {
+            'network': snapshot['network'],
+            'valid': snapshot['valid'],
+            'expires': snapshot['expires'],
+            'station_table': table.id,
+            'station_idx': station_idx,
+            'params': _params,
+            'data': {p: network_obs[p] for p in _params},
+        }
+
+        n_bytes = sum(arr.nbytes for arr in entity['data'].values()) + station_idx.nbytes
+        _logger.debug(f"{snapshot['network']}: {len(stids)} obs, {n_bytes} bytes in columns")
+        return entity
+
+    def _to_packed_entity(self, snapshot):
+        network_obs = snapshot['obs']
+        params = list(_ob_dtype.names)
+        packed = np.zeros(len(network_obs['STID']), dtype=_ob_dtype)
+        for param in params:
+            packed[param] = network_obs[param]
+
+        return {
+            'network': snapshot['network'],
+            'valid': snapshot['valid'],
+            'expires': snapshot['expires'],
+            'params': params,
+            'data': packed.view(np.uint8),
+        }
+
+    def delta(self, base, data):
+        if not self._station_tables:
+            return None
+
+        base_entities = {ent['network']: ent for ent in base['entities']}
+        if set(base_entities.keys()) != set(ent['network'] for ent in data['entities']):
+            return None
+
+        entities = [ _delta_entity(base_entities[ent['network']], ent) for ent in data['entities'] ]
+        return {'source': self._source, 'handler': self.id, 'entities': entities}
+
+    def session_messages(self):
+        if not self._station_tables:
+            return []
+
+        return [ (('station_table', table.id), {'handler': self.id, 'station_table': table.to_json()})
+                 for table in (_station_table(cfg.name) for cfg in _configs[self._source]) ]
+
     def data_check_intv(self):
         expected_times = [cfg.get_expected() for cfg in _configs[self._source]] 
         next_time = (min(expected_times) - datetime.utcnow()).total_seconds()
         return next_time + 1
 
-    def post_fetch(self):
-        if self._obs is None:
-            return
-
-        for entity in self._obs['entities']:
-            dt = datetime.strptime(entity['valid'], '%Y-%m-%d %H:%M:%S UTC')
-            self._cache[entity['network']].cache(entity, dt)
+    def cache_writes(self):
+        writes = []
+        for snapshot in self._snapshots:
+            dt = datetime.strptime(snapshot['valid'], '%Y-%m-%d %H:%M:%S UTC')
+            key = ('obs', self._source, snapshot['network'], dt)
+            writes.append((key, partial(self._cache[snapshot['network']].cache, snapshot, dt)))
+        return writes
@@ -0,0 +1,39 @@
+
+from metr_stream.handlers.handler import DataHandler
+from metr_stream.utils.stations import radars
+
+class RadarSitesHandler(DataHandler):
+    # Radar sites near a point (the `n` closest) or inside a lat/lon box ([lat_min, lon_min, lat_max, lon_max]), so
+    # clients don't have to download the whole site list.
+    def __init__(self, lat=None, lon=None, n=5, bbox=None):
+        if bbox is None and (lat is None or lon is None):
+            raise ValueError("Either a lat/lon or a bounding box is needed")
+        if n != int(n) or n < 1:
+            raise ValueError("The number of radar sites must be a positive integer")
+
+        self._lat = lat
+        self._lon = lon
+        self._n = int(n)
+        self._bbox = bbox
+
+        if bbox is None:
+            self.id = f"radars.{lat:.2f},{lon:.2f}.{self._n:d}"
+        else:
+            self.id = "radars.bbox.%.2f,%.2f,%.2f,%.2f" % tuple(bbox)
+
+    async def fetch(self, first_time=True):
+        registry = radars()
+        if self._bbox is None:
+            nearest = registry.nearest(self._lat, self._lon, n=self._n)
+        else:
+            nearest = [ (stid, None) for stid in registry.in_bbox(*self._bbox) ]
+
+        sites = []
+        for stid, dist in nearest:
+            st = registry[stid]
+            site = {'id': stid, 'name': st['name'], 'latitude': st['latitude'], 'longitude': st['longitude']}
+            if dist is not None:
+                site['distance'] = round(dist, 1)
+            sites.append(site)
+
+        return {'handler': self.id, 'radars': sites}
@@ -0,0 +1,252 @@
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+
+from metr_stream.handlers.handler import get_data_handler
+from metr_stream.handlers.hub import get_hub
+from metr_stream.utils.ring import RingBuffer
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+
+# Split deployment: one ingest process runs the hub (fetching, decoding, caching and encoding everything once) and
+# publishes the encoded frames into a shared ring buffer. Websocket workers pick the frames up from the ring and send
+# them to their connections. Workers tell the ingest process what they need over a Unix socket, one JSON message per
+# line:
+#   worker -> ingest   {"op": "hello", "worker": <id>}
+#                      {"op": "subscribe", "id": <request id>, "format": <wire format>, "request": <activate message>}
+#                      {"op": "unsubscribe", "handler": <handler id>, "format": <wire format>}
+#   ingest -> worker   {"op": "frames", "pos": <ring write position>}
+#
+# A frame's ring header says which handler and wire format it's for. Frames for a single connection (the latest data
+# for somebody who subscribed to something that was already running) also name the worker and request id.
+
+
+class RingPublisher(object):
+    # Subscribes to the hub on behalf of every worker connection that wants a handler in one wire format, so the
+    # frame goes into the ring once no matter how many workers and connections there are.
+    def __init__(self, relay, handler_id, wire_format, target=None):
+        self.handler_id = handler_id
+        self.wire_format = wire_format
+        self.workers = set()
+        self._relay = relay
+        self._target = target
+
+        # Session messages only need to go into the ring once for everybody, but a single connection needs them all
+        self.session_keys = set() if target is None else None
+
+    async def send_message(self, payload, is_binary=False, key=None, replace=True, droppable=True):
+        if not is_binary:
+            payload = payload.encode('utf-8')
+
+        worker, request = self._target if self._target is not None else (None, None)
+        header = {'handler': self.handler_id, 'format': self.wire_format, 'binary': is_binary, 'worker': worker,
+                  'request': request, 'key': key, 'replace': replace, 'droppable': droppable}
+        self._relay.publish(header, payload)
+
+
+class IngestRelay(object):
+    def __init__(self, ring_path, control_path, ring_bytes=512 * 1024 ** 2):
+        self._ring = RingBuffer.create(ring_path, ring_bytes)
+        self._control_path = control_path
+        self._server = None
+
+        self._workers = {}
+        self._publishers = {}
+
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.n_too_big = 0
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._serve_worker, path=self._control_path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(self._control_path):
+            os.unlink(self._control_path)
+
+    def publish(self, header, payload):
+        try:
+            pos = self._ring.write(header, payload)
+        except ValueError as exc:
+            self.n_too_big += 1
+            _logger.error(f"Can't publish {header['handler']}: {exc}")
+            return
+
+        self.n_frames += 1
+        self.n_bytes += len(payload)
+
+        note = (json.dumps({'op': 'frames', 'pos': pos}) + "\n").encode('utf-8')
+        for writer in self._workers.values():
+            writer.write(note)
+
+    async def _serve_worker(self, reader, writer):
+        worker = None
+        try:
+            async for line in reader:
+                msg = json.loads(line.decode('utf-8'))
+                if msg['op'] == 'hello':
+                    worker = msg['worker']
+                    self._workers[worker] = writer
+                    _logger.info(f"Worker {worker} connected")
+                elif msg['op'] == 'subscribe':
+                    self._subscribe(worker, msg)
+                elif msg['op'] == 'unsubscribe':
+                    self._unsubscribe(worker, msg['handler'], msg['format'])
+        finally:
+            _logger.info(f"Worker {worker} disconnected")
+            for handler_id, wire_format in list(self._publishers.keys()):
+                self._unsubscribe(worker, handler_id, wire_format)
+            self._workers.pop(worker, None)
+            writer.close()
+
+    def _subscribe(self, worker, msg):
+        request = dict(msg['request'])
+        try:
+            handler = get_data_handler(request.pop('type'))(**request)
+        except Exception as exc:
+            _logger.error(f"Bad request from worker {worker}: {exc}")
+            return
+
+        key = (handler.id, msg['format'])
+        publisher = self._publishers.get(key)
+        if publisher is None:
+            publisher = self._publishers[key] = RingPublisher(self, handler.id, msg['format'])
+            publisher.workers.add(worker)
+
+            async def subscribe():
+                if self._publishers.get(key) is publisher:
+                    await get_hub().subscribe(handler, publisher)
+
+            asyncio.ensure_future(subscribe())
+        else:
+            publisher.workers.add(worker)
+            target = RingPublisher(self, handler.id, msg['format'], target=(worker, msg['id']))
+            asyncio.ensure_future(get_hub().resend(handler.id, target))
+
+    def _unsubscribe(self, worker, handler_id, wire_format):
+        publisher = self._publishers.get((handler_id, wire_format))
+        if publisher is None:
+            return
+
+        publisher.workers.discard(worker)
+        if len(publisher.workers) == 0:
+            del self._publishers[(handler_id, wire_format)]
+            get_hub().unsubscribe(handler_id, publisher)
+
+    def stats(self):
+        return {'n_workers': len(self._workers), 'n_publishers': len(self._publishers), 'n_frames': self.n_frames,
+                'n_bytes': self.n_bytes, 'n_too_big': self.n_too_big, 'ring_pos': self._ring.write_pos}
+
+
+class RemoteHub(object):
+    # Takes the hub's place in a websocket worker. Subscriptions are passed on to the ingest process, and frames
+    # come back through the ring. Deltas and hash revalidation need per-connection state in the ingest process's
+    # hub, so connections to a worker always get whole frames.
+    def __init__(self, worker, ring_path, control_path):
+        self._worker = worker
+        self._ring_path = ring_path
+        self._control_path = control_path
+
+        self._subs = {}
+        self._requests = {}
+        self._request_ids = itertools.count()
+
+        self._ring = None
+        self._pos = 0
+        self._writer = None
+        self._task = None
+
+    async def connect(self):
+        self._ring = RingBuffer(self._ring_path)
+        self._pos = self._ring.write_pos
+
+        reader, self._writer = await asyncio.open_unix_connection(self._control_path)
+        self._send_op({'op': 'hello', 'worker': self._worker})
+        self._task = asyncio.ensure_future(self._run(reader))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._ring is not None:
+            self._ring.close()
+
+    async def subscribe(self, handler, subscriber, delta=False, known_hash=None):
+        key = (handler.id, _wire_format(subscriber))
+        subs = self._subs.setdefault(key, [])
+        if subscriber not in subs:
+            subs.append(subscriber)
+
+        request_id = next(self._request_ids)
+        self._requests[request_id] = (handler.id, subscriber)
+        self._send_op({'op': 'subscribe', 'id': request_id, 'format': key[1], 'request': handler.request})
+        return True
+
+    def unsubscribe(self, handler_id, subscriber):
+        for key in [ key for key in self._subs.keys() if key[0] == handler_id ]:
+            subs = self._subs[key]
+            if subscriber not in subs:
+                continue
+
+            subs.remove(subscriber)
+            if len(subs) == 0:
+                del self._subs[key]
+                self._send_op({'op': 'unsubscribe', 'handler': handler_id, 'format': key[1]})
+
+        self._requests = {req_id: (hid, sub) for req_id, (hid, sub) in self._requests.items()
+                          if hid != handler_id or sub is not subscriber}
+
+    def ack(self, handler_id, subscriber, valid):
+        pass
+
+    def _send_op(self, msg):
+        self._writer.write((json.dumps(msg) + "\n").encode('utf-8'))
+
+    async def _run(self, reader):
+        async for line in reader:
+            msg = json.loads(line.decode('utf-8'))
+            if msg['op'] != 'frames':
+                continue
+
+            records, self._pos, lost = self._ring.read(self._pos)
+            if lost > 0:
+                _logger.error(f"Worker {self._worker} fell behind and lost {lost} bytes of frames")
+
+            for header, payload in records:
+                await self._dispatch(header, payload)
+
+        # Nothing works without the ingest process, so take the worker down with it
+        _logger.error(f"Worker {self._worker} lost its connection to the ingest process")
+        os.kill(os.getpid(), signal.SIGINT)
+
+    async def _dispatch(self, header, payload):
+        if header['worker'] is not None:
+            if header['worker'] != self._worker or header['request'] not in self._requests:
+                return
+            subscribers = [ self._requests[header['request']][1] ]
+        else:
+            subscribers = self._subs.get((header['handler'], header['format']), [])
+
+        if not header['binary']:
+            payload = payload.decode('utf-8')
+
+        sends = [ sub.send_message(payload, is_binary=header['binary'], key=header['key'], replace=header['replace'],
+                                   droppable=header['droppable'])
+                  for sub in subscribers ]
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                _logger.error(f"Error sending {header['handler']}: {result}")
+
+
+def _wire_format(subscriber):
+    return getattr(subscriber, 'wire_format', 'json')
@@ -3,17 +3,57 @@ import json
 import zlib
 
 from metr_stream.handlers.handler import DataHandler
+from metr_stream.utils.static import get_asset
+from metr_stream.utils.tiles import TileSet, max_zoom, extent, tile_bounds, tile_counts
+
 
 class ShapefileHandler(DataHandler):
-    def __init__(self, domain, name):
+    # With a zoom, each subscription is one tile, so clients panning around share tiles (and their cached frames)
+    # instead of each getting their own bundle of them
+    def __init__(self, domain, name, zoom=None, tile=None):
+        if zoom is not None:
+            if not 0 <= zoom <= max_zoom:
+                raise ValueError(f"Zoom level must be between 0 and {max_zoom}")
+            if tile is None:
+                raise ValueError("Tiled shapefiles need a tile")
+
+            n_x, n_y = tile_counts(zoom)
+            if not (0 <= tile[0] < n_x and 0 <= tile[1] < n_y):
+                raise ValueError(f"Tile {tile} doesn't exist at zoom {zoom}")
+
         self._domain = domain
         self._name = name
+        self._fname = f"data/{self._domain}/{self._name}.json.gz"
+        self._zoom = zoom
+        self._tile = tuple(tile) if zoom is not None else None
 
         self.id = f"shapefile.{self._domain}.{self._name}"
+        if self._zoom is not None:
+            self.id += f".z{self._zoom}.{self._tile[0]}-{self._tile[1]}"
 
     async def fetch(self, first_time=True):
-        fname = f"data/{self._domain}/{self._name}.json.gz"
-        shp_str = zlib.decompress(open(fname, 'rb').read()).decode('utf-8')
-        shp_json = json.loads(shp_str)
+        if self._zoom is None:
+            return self._document()
+
+        tileset = TileSet.get(self._fname)
+        x, y = self._tile
+        coords, offsets = await tileset.tile(self._zoom, x, y)
+        entity = {'x': x, 'y': y, 'bounds': tile_bounds(self._zoom, x, y), 'valid': tileset.version,
+                  'coords': coords, 'offsets': offsets}
+
+        return {'handler': self.id, 'zoom': self._zoom, 'extent': extent, 'entities': [ entity ],
+                'hash': tileset.version}
+
+    def snapshot(self):
+        # The fetch loop hardly ever runs, so the file is checked again for everyone who subscribes to the whole thing
+        if self._zoom is None:
+            return self._document()
+        return None
+
+    def _document(self):
+        # Whole documents for clients that don't ask for tiles are parsed once and kept until the file changes
+        asset = get_asset(self._fname)
+        shp_json = dict(asset.content(lambda raw: json.loads(zlib.decompress(raw).decode('utf-8'))))
         shp_json['handler'] = self.id
+        shp_json['hash'] = asset.hash
         return shp_json
@@ -2,15 +2,26 @@
 import json
 
 from metr_stream.handlers.handler import DataHandler
+from metr_stream.utils.static import get_asset
 
 class StaticHandler(DataHandler):
+    # Clients have always known every gui file as just "gui", but each file still needs its own subscription
+    wire_id = 'gui'
+
     def __init__(self, static):
         self._static = static
-        self.id = "gui"
+        self.id = f"gui.{self._static}"
 
     async def fetch(self, first_time=True):
-        with open(f'static/{self._static}.json', 'rb') as fstat:
-            static_data = json.loads(fstat.read().decode('utf-8'))
+        return self._static_msg()
+
+    def snapshot(self):
+        # The fetch loop hardly ever runs, so the file is checked again for everyone who subscribes
+        return self._static_msg()
+
+    def _static_msg(self):
+        asset = get_asset(f'static/{self._static}.json')
+        static_data = asset.content(lambda raw: json.loads(raw.decode('utf-8')))
 
-        static_msg = {'handler': self.id, self._static:static_data}
+        static_msg = {'handler': self.wire_id, self._static:static_data, 'hash': asset.hash}
         return static_msg
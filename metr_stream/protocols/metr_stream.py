@@ -1,13 +1,11 @@
 
 import logging
 import json
-import multiprocessing
-import zlib
 
 from metr_stream.protocols.websocket import WebSocketProtocol
-from metr_stream.handlers.handler import get_data_handler
-from metr_stream.utils.errors import StaleDataError, NoNewDataError
-from metr_stream.utils.timer import Timer
+from metr_stream.handlers.handler import get_data_handler, data_features
+from metr_stream.handlers.hub import get_hub
+from metr_stream.utils.frame import wire_formats
 
 
 class MetrStreamProtocol(WebSocketProtocol):
@@ -16,8 +14,11 @@ class MetrStreamProtocol(WebSocketProtocol):
 
         self._logger = logging.getLogger(__name__)
         self._logger.setLevel(logging.DEBUG)
-        self._active_timers = {}
+        self._active_handlers = {}   # hub id -> the id the client knows it by
         self._data_path = data_path
+        self.wire_format = 'json'
+        self.features = []
+        self.session_keys = set()
 
     async def on_connect(self, request):
         self._source = request.remote
@@ -29,60 +30,64 @@ class MetrStreamProtocol(WebSocketProtocol):
         req_action = msg_json.pop('action')
         if req_action == 'activate':
             req_type = msg_json.pop('type')
-            req_handler = get_data_handler(req_type)(**msg_json)
-
-            success = await self.fetch_data(req_handler, first_time=True)
+            delta = msg_json.pop('delta', False)
+            known_hash = msg_json.pop('hash', None)
+            try:
+                handler_cls = get_data_handler(req_type)
+                features = [ feat for feat in self.features if feat in handler_cls.features ]
+                if len(features) > 0:
+                    msg_json['features'] = features
+                req_handler = handler_cls(**msg_json)
+            except Exception as exc:
+                self._logger.error(f"Bad {req_type} request from {self._source}: {exc}")
+                await self.send_message(json.dumps({'handler': req_type, 'error': str(exc)}))
+                return
+
+            # So the handler can be made again in another process (see handlers/relay.py)
+            req_handler.request = dict(msg_json, type=req_type)
+
+            handler_id = req_handler.id
+            self._active_handlers[handler_id] = req_handler.wire_id
+
+            success = await get_hub().subscribe(req_handler, self, delta=delta, known_hash=known_hash)
             if success:
-                handler_id = req_handler.id
                 self._logger.debug(f"Activating {handler_id} for {self._source}")
 
+        elif req_action == 'hello':
+            # Clients list the wire formats they understand, best first. Old clients never say hello and get JSON.
+            client_formats = msg_json.get('formats', [])
+            self.wire_format = next((fmt for fmt in client_formats if fmt in wire_formats), 'json')
+            self.features = [ feat for feat in msg_json.get('features', []) if feat in data_features ]
+            self._logger.debug(f"Using {self.wire_format} frames for {self._source} with features {self.features}")
+            await self.send_message(json.dumps({'action': 'hello', 'format': self.wire_format,
+                                                'features': self.features}))
+
+        elif req_action == 'ack':
+            for handler_id in self._hub_ids(msg_json['handler']):
+                get_hub().ack(handler_id, self, msg_json['valid'])
+
         elif req_action == 'deactivate':
-            self._logger.debug(f"Deactivating {msg_json['handler']} for {self._source}")
-            handler_timer = self._active_timers.pop(msg_json['handler'])
-            handler_timer.stop()
+            for handler_id in self._hub_ids(msg_json['handler']):
+                self._logger.debug(f"Deactivating {handler_id} for {self._source}")
+                del self._active_handlers[handler_id]
+                get_hub().unsubscribe(handler_id, self)
         else:
             self._logger.error(f"Unknown request action: {req_action}")
 
-    async def send_message(self, payload, is_binary=False):
+    def _hub_ids(self, wire_id):
+        # Clients refer to handlers by the id in their messages, which a few handlers share between subscriptions
+        return [ handler_id for handler_id, active_wire_id in self._active_handlers.items()
+                 if wire_id in (handler_id, active_wire_id) ]
+
+    async def send_message(self, payload, is_binary=False, key=None, replace=True, droppable=True):
         self._logger.info(f"Sending {len(payload)} bytes to {self._source}")
-        await super(MetrStreamProtocol, self).send_message(payload, is_binary=is_binary)
+        await super(MetrStreamProtocol, self).send_message(payload, is_binary=is_binary, key=key, replace=replace,
+                                                           droppable=droppable)
 
     async def on_close(self):
-        for timer in self._active_timers.values():
-            timer.stop()
-
-        self._logger.info(f"Connection from {self._source} closed")
-
-    async def fetch_data(self, handler, first_time=True, is_binary=False):
-        async def do_fetch():
-            await self.fetch_data(handler, first_time=False, is_binary=is_binary)
-
-        handler_timer = Timer(do_fetch, handler.data_check_intv(), single_shot=True)
-        handler_timer.start()
-        self._active_timers[handler.id] = handler_timer
-
-        success = True
-        try:
-            req_data = await handler.fetch(first_time=first_time)
-        except StaleDataError as exc:
-            self._logger.error(f"Stale data in {exc.handler}")
-            req_data = {'handler': exc.handler, 'error':'stale data'}
-            success = False
-        except NoNewDataError as exc:
-            self._logger.info(f"No new data for {exc.handler}")
-            return success
-        except Exception as exc:
-            self._logger.error(f"Error in {handler.id}: {exc}")
-            req_data = {'handler': handler.id, 'error':'internal server error'}
-            success = False   
-
-        data_json = json.dumps(req_data)
-        if req_data['handler'].startswith('shapefile') or req_data['handler'].startswith('level2radar') or req_data['handler'].startswith('obs'):
-            data_json = zlib.compress(data_json.encode('utf-8'))
-            is_binary = True
-        await self.send_message(data_json, is_binary=is_binary)
-
-        proc = multiprocessing.Process(target=handler.post_fetch)
-        proc.start()
-
-        return success
+        hub = get_hub()
+        for handler_id in self._active_handlers:
+            hub.unsubscribe(handler_id, self)
+        self._active_handlers = {}
+
+        self._logger.info(f"Connection from {self._source} closed (send queue: {self.queue_stats()})")
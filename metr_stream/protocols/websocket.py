@@ -1,11 +1,31 @@
 
 import aiohttp
 
+import asyncio
+import logging
+
+from metr_stream.utils.send_queue import SendQueue
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+
+
 class WebSocketProtocol(object):
     _connections = []
 
-    def __init__(self):
+    # Seconds a client that's too far behind gets to close before the connection is cut
+    close_timeout = 5
+
+    # Clients whose send queue hasn't emptied in max_send_lag seconds, or that are so far behind that their queue
+    # overflows, get disconnected
+    def __init__(self, max_queue_frames=32, max_queue_bytes=64 * 1024 ** 2, max_send_lag=30):
         self._ws = None
+        self._request = None
+        self._queue = None
+        self._queue_task = None
+        self._queue_opts = {'max_frames': max_queue_frames, 'max_bytes': max_queue_bytes}
+        self._max_send_lag = max_send_lag
+        self._dropping = False
 
     async def on_connect(self, req):
         pass
@@ -13,45 +33,105 @@ class WebSocketProtocol(object):
     async def on_message(self, msg):
         pass
 
-    async def send_message(self, msg, is_binary=False):
-        if self._ws is None:
+    async def send_message(self, msg, is_binary=False, key=None, replace=True, droppable=True):
+        # Queues the message and returns right away; see SendQueue for what key and replace do
+        if self._ws is None or self._queue is None:
             raise ValueError("Open a connection before sending a message!")
 
+        self._queue.put(msg, is_binary=is_binary, key=key, replace=replace, droppable=droppable)
+
+        too_slow = self._queue.overflowed or self._queue.lag() > self._max_send_lag
+        if too_slow and not self._dropping:
+            self._dropping = True
+            asyncio.ensure_future(self._drop_slow())
+
+    async def _send_frame(self, msg, is_binary):
         if is_binary:
             await self._ws.send_bytes(msg)
         else:
             await self._ws.send_str(msg)
 
+    async def _drop_slow(self):
+        _logger.warning(f"Disconnecting {self._request.remote}, which is {self._queue.lag():.0f} s behind: "
+                        f"{self._queue.stats()}")
+
+        # Let go of everything queued. The writer is probably stuck waiting for the client, but cancelling it would
+        # cancel the close too (they wait on the same drain), so it's left to fail when the connection goes.
+        self._queue.close()
+
+        try:
+            await asyncio.wait_for(self._ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER,
+                                                  message=b'Too far behind'), WebSocketProtocol.close_timeout)
+        except Exception:
+            self._request.transport.abort()
+
+    def queue_stats(self):
+        return self._queue.stats() if self._queue is not None else None
+
+    @staticmethod
+    def all_queue_stats():
+        return [ dict(conn.queue_stats(), remote=conn._request.remote) for conn in WebSocketProtocol._connections ]
+
+    @staticmethod
+    async def report_queues(interval=300):
+        # Every so often, logs the send queues of the connections that are behind or have had frames dropped
+        while True:
+            await asyncio.sleep(interval)
+
+            all_stats = WebSocketProtocol.all_queue_stats()
+            behind = [ stats for stats in all_stats if stats['depth'] > 0 or stats['n_dropped'] > 0 ]
+            _logger.info(f"{len(all_stats)} connections, {len(behind)} behind or dropping frames")
+            for stats in behind:
+                _logger.info(f"Send queue for {stats['remote']}: {stats}")
+
     async def on_close(self):
         pass
 
     @staticmethod
     async def on_shutdown(app):
-        for ws in WebSocketProtocol._connections:
-            await ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, 
-                           message='Server is shutting down')
+        for conn in list(WebSocketProtocol._connections):
+            await conn._ws.close(code=aiohttp.WSCloseCode.GOING_AWAY,
+                                 message='Server is shutting down')
+
+    async def _run_queue(self):
+        try:
+            await self._queue.run()
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            if not self._dropping:
+                _logger.error(f"Error sending to {self._request.remote}: {exc}")
 
     async def __call__(self, request):
         self._ws = aiohttp.web.WebSocketResponse()
         await self._ws.prepare(request)
 
-        WebSocketProtocol._connections.append(self._ws)
+        self._request = request
+        self._queue = SendQueue(self._send_frame, **self._queue_opts)
+        self._queue_task = asyncio.ensure_future(self._run_queue())
 
-        await self.on_connect(request)
-
-        async for msg in self._ws:
-            if msg.type != aiohttp.WSMsgType.TEXT:
-                continue
-
-            if msg.data == 'close':
-                await ws.close()
-            else:
-                await self.on_message(msg.data)
+        WebSocketProtocol._connections.append(self)
 
-        await self.on_close()
+        await self.on_connect(request)
 
-        ws = self._ws
-        self._ws = None
-        WebSocketProtocol._connections.remove(ws)
+        # Whatever happens to the connection, its subscriptions have to be let go of
+        try:
+            async for msg in self._ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+
+                if msg.data == 'close':
+                    await self._ws.close()
+                else:
+                    await self.on_message(msg.data)
+        finally:
+            await self.on_close()
+
+            self._queue_task.cancel()
+            self._queue.close()
+
+            ws = self._ws
+            self._ws = None
+            WebSocketProtocol._connections.remove(self)
 
         return ws
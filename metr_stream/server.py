@@ -3,63 +3,80 @@ import logging
 import asyncio
 import signal
 import os
-from datetime import datetime, timedelta
+import argparse
+import multiprocessing
 
 from metr_stream.protocols.hollaback import HollaBackProtocol
 from metr_stream.protocols.metr_stream import MetrStreamProtocol
+from metr_stream.protocols.websocket import WebSocketProtocol
+from metr_stream.handlers.hub import init_hub, set_hub
+from metr_stream.handlers.relay import IngestRelay, RemoteHub
+from metr_stream.handlers.level2radar import init_volume_store, init_prefetcher, SiteIndex
+from metr_stream.utils.pool import init_decode_pool
+from metr_stream.utils.download import init_client
+from metr_stream.utils.cache import init_cache_index
+from metr_stream.utils.writer import init_cache_writer
+from metr_stream.utils.scheduler import init_scheduler
+from metr_stream.utils.ring import ring_path
 
 from aiohttp import web
 
-class Cleaner(object):
-    def __init__(self, interval, max_age, data_dir):
-        self._intv = interval
-        self._max_age = timedelta(seconds=max_age)
-        self._path = data_dir
+_log_format = "%(levelname)s|%(name)s|%(asctime)-15s: %(message)s"
+_queue_report_intv = 300
 
-        self._logger = logging.getLogger(__name__)
-        self._logger.setLevel(logging.INFO)
 
-    async def run_cleaner(self):
-        self._logger.info("Starting cleaner process")
-        while True:
-            await asyncio.sleep(self._intv)
+async def start_queue_reports(app):
+    app['queue_reports'] = app.loop.create_task(WebSocketProtocol.report_queues(_queue_report_intv))
 
-            try:
-                self._cleanup()
-            except Exception as exc:
-                self._logger.error(str(exc))
 
-    def _cleanup(self):
-        now = datetime.utcnow()
-        self._logger.info(f"Cleaning '{self._path}'")
-        for root, dnames, fnames in os.walk(self._path):
-            if os.path.basename(root) in ['geo', 'l2raw']:
-                continue
-
-            self._logger.debug(f"Cleaning '{root}'")
-
-            for fname in fnames:
-                if not fname.endswith('.json'):
-                    continue
-
-                full_fname = os.path.join(root, fname)
-
-                dt = datetime.utcfromtimestamp(os.path.getmtime(full_fname))
-                if dt < now - self._max_age:
-                    os.unlink(full_fname)
+async def stop_queue_reports(app):
+    app['queue_reports'].cancel()
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Serve websockets from this many worker processes, with fetching and decoding in this one")
+    args = parser.parse_args()
+
     host = "127.0.0.1"
     port = 8001
     data_path = "data"
-    logging.basicConfig(format="%(levelname)s|%(name)s|%(asctime)-15s: %(message)s")
+    payload_cache_bytes = 256 * 1024 * 1024
+    delta_keyframe_every = 12
+    decode_workers = 2
+    decodes_per_worker = 1
+    volume_store_bytes = 1024 ** 3
+    http_conns_per_host = 8
+    http_timeout = 60
+    http_retries = 2
+    cache_max_age = 2 * 3600
+    cache_max_bytes = 4 * 1024 ** 3
+    cache_write_queue = 256
+    cache_write_policy = 'drop_oldest'
+    ring_bytes = 512 * 1024 ** 2
+    send_queue = {'max_queue_frames': 32, 'max_queue_bytes': 64 * 1024 ** 2, 'max_send_lag': 30}
+    # (site, field, tilt) to keep decoded whether or not anybody is watching, and how many tilts either side of a
+    # watched one to decode ahead of time
+    warm_set = [ ('KTLX', 'REF', 0.5), ('KTLX', 'VEL', 0.5) ]
+    prefetch_adjacent = 1
+    logging.basicConfig(format=_log_format)
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
 
-    protocol = MetrStreamProtocol(data_path)
+    init_hub(payload_cache_bytes=payload_cache_bytes, keyframe_every=delta_keyframe_every)
+    scheduler = init_scheduler()
+    init_volume_store(max_bytes=volume_store_bytes)
+    prefetcher = init_prefetcher(warm=warm_set, adjacent=prefetch_adjacent)
+    decode_pool = init_decode_pool(max_workers=decode_workers, max_per_worker=decodes_per_worker)
+    http_client = init_client(limit_per_host=http_conns_per_host, timeout=http_timeout, retries=http_retries)
+
+    # The hub is shared across the whole process, but each connection needs its own protocol object so the hub can
+    # tell subscribers apart.
+    async def metr_stream(request):
+        return await MetrStreamProtocol(data_path, **send_queue)(request)
 
-    cleaner = Cleaner(300, 2 * 3600, data_path)
+    cleaner = init_cache_index(data_path, max_age=cache_max_age, max_bytes=cache_max_bytes, interval=300)
 
     async def start_cleaner(app):
         app['cleaner'] = app.loop.create_task(cleaner.run_cleaner())
@@ -67,14 +84,128 @@ def main():
     async def cleanup_cleaner(app):
         app['cleaner'].cancel()
         await app['cleaner']
+
+    writer = init_cache_writer(max_pending=cache_write_queue, policy=cache_write_policy)
+
+    async def start_writer(app):
+        app['writer'] = app.loop.create_task(writer.run())
+
+    async def stop_writer(app):
+        app['writer'].cancel()
+        logger.info(f"Cache writer stats: {writer.stats()}")
+
+    async def report_polling(app):
+        logger.info(f"Scheduler stats: {scheduler.stats()}")
+        for site, stats in SiteIndex.poll_stats().items():
+            logger.info(f"Polling stats for {site}: {stats}")
+
+    async def start_prefetcher(app):
+        prefetcher.start()
+
+    async def stop_prefetcher(app):
+        prefetcher.stop()
+        logger.info(f"Prefetch stats: {prefetcher.stats()}")
+
+    async def shutdown_decode_pool(app):
+        decode_pool.shutdown()
+
+    async def close_http_client(app):
+        logger.info(f"HTTP client stats: {http_client.stats()}")
+        await http_client.close()
     
     app = web.Application()
-    app.add_routes([web.get('/', protocol)])
 
-    app.on_shutdown.append(type(protocol).on_shutdown)
     app.on_startup.append(start_cleaner)
+    app.on_startup.append(start_writer)
+    app.on_startup.append(start_prefetcher)
+    app.on_cleanup.append(stop_writer)
+    app.on_cleanup.append(stop_prefetcher)
+    app.on_cleanup.append(report_polling)
+    app.on_cleanup.append(shutdown_decode_pool)
+    app.on_cleanup.append(close_http_client)
+
+    if args.workers > 0:
+        run_ingest(app, args.workers, host, port, data_path, ring_bytes, send_queue)
+    else:
+        app.add_routes([web.get('/', metr_stream)])
+        app.on_startup.append(start_queue_reports)
+        app.on_shutdown.append(MetrStreamProtocol.on_shutdown)
+        app.on_cleanup.append(stop_queue_reports)
+        web.run_app(app, host=host, port=port)
+
+
+def run_ingest(app, n_workers, host, port, data_path, ring_bytes, send_queue):
+    # This process does all the fetching, decoding and encoding and publishes the frames to a ring buffer in shared
+    # memory. The websocket workers share the port and pass the frames on to their connections.
+    logger = logging.getLogger(__name__)
+
+    ring_file = ring_path(f"metr_stream.{os.getpid()}.ring")
+    control_file = ring_path(f"metr_stream.{os.getpid()}.sock")
+    relay = IngestRelay(ring_file, control_file, ring_bytes=ring_bytes)
+    workers = []
+
+    async def start_relay(app):
+        await relay.start()
+
+        ctx = multiprocessing.get_context('spawn')
+        for iwkr in range(n_workers):
+            args = (iwkr, host, port, data_path, ring_file, control_file, send_queue)
+            proc = ctx.Process(target=run_worker, args=args)
+            proc.start()
+            workers.append(proc)
+        logger.info(f"Started {n_workers} websocket workers on {host}:{port}")
+
+    async def stop_relay(app):
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            proc.join()
+
+        logger.info(f"Relay stats: {relay.stats()}")
+        await relay.stop()
+        os.unlink(ring_file)
+
+    app.on_startup.append(start_relay)
+    app.on_cleanup.insert(0, stop_relay)
+
+    # There's nothing to serve here, so run the app's startup and cleanup hooks around the event loop by hand
+    loop = asyncio.get_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+
+def run_worker(worker, host, port, data_path, ring_file, control_file, send_queue):
+    logging.basicConfig(format=_log_format)
+
+    hub = set_hub(RemoteHub(worker, ring_file, control_file))
+
+    async def metr_stream(request):
+        return await MetrStreamProtocol(data_path, **send_queue)(request)
+
+    async def connect_hub(app):
+        await hub.connect()
+
+    async def close_hub(app):
+        await hub.close()
+
+    app = web.Application()
+    app.add_routes([web.get('/', metr_stream)])
+
+    app.on_startup.append(connect_hub)
+    app.on_startup.append(start_queue_reports)
+    app.on_shutdown.append(MetrStreamProtocol.on_shutdown)
+    app.on_cleanup.append(stop_queue_reports)
+    app.on_cleanup.append(close_hub)
 
-    web.run_app(app, host=host, port=port)
+    # Every worker listens on the same port, and the kernel spreads the connections out among them
+    web.run_app(app, host=host, port=port, reuse_port=True, print=None)
 
 if __name__ == "__main__":
     main()
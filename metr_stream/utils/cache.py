@@ -1,7 +1,149 @@
 
+import numpy as np
+
+import asyncio
 import json
+import logging
+import heapq
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import os
+import sqlite3
+
+from metr_stream.utils.frame import dump_arrays, load_arrays
+
+_cache_index = None
+
+def get_cache_index():
+    global _cache_index
+    if _cache_index is None:
+        _cache_index = CacheIndex("data")
+
+    return _cache_index
+
+
+def init_cache_index(data_dir, **kwargs):
+    global _cache_index
+    _cache_index = CacheIndex(data_dir, **kwargs)
+    return _cache_index
+
+
+class CacheIndex(object):
+    # In-memory index of every file in the cache. Files are registered when they're written, so eviction never has to
+    # walk the data directory: expired files come off a min-heap, and if the cache is still over its size budget, the
+    # least recently used files go next. The directory is only scanned once, at startup.
+    _skip_dirs = ['geo', 'l2raw']
+    _exts = ('.json', '.npy')
+
+    def __init__(self, data_dir, max_age=2 * 3600, max_bytes=4 * 1024 ** 3, interval=300):
+        self._path = data_dir
+        self._max_age = max_age
+        self._max_bytes = max_bytes
+        self._intv = interval
+
+        self._entries = OrderedDict()   # path -> (n_bytes, expires), least recently used first
+        self._expiry = []               # heap of (expires, path); stale items are skipped when popped
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.INFO)
+
+    def register(self, path, n_bytes, expires=None):
+        if expires is None:
+            expires = time.time() + self._max_age
+
+        with self._lock:
+            if path in self._entries:
+                self._n_bytes -= self._entries.pop(path)[0]
+
+            self._entries[path] = (n_bytes, expires)
+            self._n_bytes += n_bytes
+            heapq.heappush(self._expiry, (expires, path))
+
+    def touch(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+
+    def add_evict_listener(self, listener):
+        self._listeners.append(listener)
+
+    @property
+    def n_bytes(self):
+        return self._n_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def run_cleaner(self):
+        loop = asyncio.get_event_loop()
+
+        self._logger.info(f"Indexing '{self._path}'")
+        for path, n_bytes, expires in await loop.run_in_executor(None, self._scan):
+            self.register(path, n_bytes, expires=expires)
+        self._logger.info(f"Indexed {len(self)} files ({self._n_bytes} bytes)")
+
+        while True:
+            await asyncio.sleep(self._intv)
+
+            try:
+                await self._cleanup()
+            except Exception as exc:
+                self._logger.error(str(exc))
+
+    def _scan(self):
+        found = []
+        for root, dnames, fnames in os.walk(self._path):
+            dnames[:] = [ dname for dname in dnames if dname not in CacheIndex._skip_dirs ]
+
+            for fname in fnames:
+                if not fname.endswith(CacheIndex._exts):
+                    continue
+
+                full_fname = os.path.join(root, fname)
+                stat = os.stat(full_fname)
+                found.append((full_fname, stat.st_size, stat.st_mtime + self._max_age))
+        return found
+
+    async def _cleanup(self):
+        now = time.time()
+        evicted = []
+        with self._lock:
+            while len(self._expiry) > 0 and self._expiry[0][0] <= now:
+                expires, path = heapq.heappop(self._expiry)
+                entry = self._entries.get(path)
+                if entry is not None and entry[1] == expires:
+                    self._n_bytes -= self._entries.pop(path)[0]
+                    evicted.append(path)
+
+            n_expired = len(evicted)
+            while self._n_bytes > self._max_bytes and len(self._entries) > 0:
+                path, (n_bytes, _) = self._entries.popitem(last=False)
+                self._n_bytes -= n_bytes
+                evicted.append(path)
+
+        if len(evicted) == 0:
+            return
+
+        self._logger.info(f"Evicting {n_expired} expired and {len(evicted) - n_expired} least recently used files "
+                          f"({self._n_bytes} bytes left)")
+
+        await asyncio.get_event_loop().run_in_executor(None, _unlink_all, evicted)
+        for listener in self._listeners:
+            listener(evicted)
+
+
+def _unlink_all(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
 
 class Cache(object):
     def __init__(self, fname_func, timeout=timedelta(minutes=5)):
@@ -13,13 +155,15 @@ class Cache(object):
             return None
 
         fname = self._fname(dt)
-        json_str = json.loads(open(fname, 'rb').read().decode('utf-8'))
+        json_str = json.loads(open(fname, 'rb').read().decode('utf-8'), object_hook=load_arrays)
+        get_cache_index().touch(fname)
         return json_str
 
     def cache(self, data, dt):
-        json_str = json.dumps(data).encode('utf-8')
+        json_str = json.dumps(data, default=dump_arrays).encode('utf-8')
         fname = self._fname(dt)
         open(fname, 'wb').write(json_str)
+        get_cache_index().register(fname, len(json_str))
 
     def is_cached(self, dt):
         fname = self._fname(dt)
@@ -32,3 +176,86 @@ class Cache(object):
         fname = self._fname(dt)
         if datetime.utcfromtimestamp(os.path.getmtime(fname)) < datetime.utcnow() - self._timeout:
             return True
+
+
+class SweepCache(object):
+    # Sweeps are stored as raw .npy files that can be memory-mapped on load, with an SQLite index keyed by (site,
+    # field, elevation, time). Expiry checks only hit the index. Rows for evicted files are deleted when the cleaner
+    # says so, but the cleaner may have been running before this cache was made, so is_cached() also makes sure the
+    # file is still there.
+    def __init__(self, cache_dir, timeout=timedelta(minutes=15)):
+        self._dir = cache_dir
+        self._timeout = timeout
+
+        self._local = threading.local()
+
+        get_cache_index().add_evict_listener(self._forget)
+
+    def _db(self):
+        # Writes happen on the cache writer's thread, so each thread gets its own SQLite connection.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(self._dir, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self._dir, 'index.sqlite'), timeout=10)
+            conn.execute("CREATE TABLE IF NOT EXISTS sweeps (site TEXT, field TEXT, elev REAL, dt TEXT, "
+                         "fname TEXT, meta TEXT, written REAL, PRIMARY KEY (site, field, elev, dt))")
+            self._local.conn = conn
+        return conn
+
+    def _key(self, site, field, elev, dt):
+        return (site, field, round(float(elev), 1), dt.strftime('%Y%m%d_%H%M'))
+
+    def load_cache(self, site, field, elev, dt):
+        key = self._key(site, field, elev, dt)
+        row = self._db().execute("SELECT fname, meta, written FROM sweeps WHERE site=? AND field=? AND elev=? AND dt=?",
+                                 key).fetchone()
+        if row is None:
+            return None
+
+        fname, meta, written = row
+        if written < time.time() - self._timeout.total_seconds():
+            return None
+
+        try:
+            data = np.load(fname, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            self.remove(*key)
+            return None
+
+        get_cache_index().touch(fname)
+        return json.loads(meta), data
+
+    def cache(self, site, field, elev, dt, meta, data):
+        key = self._key(site, field, elev, dt)
+        fname = os.path.join(self._dir, "%s_%s_%04.1f_%s.npy" % key)
+
+        # Write to a temporary file first so a reader never memory-maps a half-written array.
+        tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp_fname, 'wb') as fcache:
+            np.save(fcache, data)
+        os.replace(tmp_fname, fname)
+        get_cache_index().register(fname, os.path.getsize(fname))
+
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO sweeps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       key + (fname, json.dumps(meta), time.time()))
+
+    def is_cached(self, site, field, elev, dt):
+        key = self._key(site, field, elev, dt)
+        row = self._db().execute("SELECT fname FROM sweeps WHERE site=? AND field=? AND elev=? AND dt=?",
+                                 key).fetchone()
+        if row is None:
+            return False
+
+        if not os.path.exists(row[0]):
+            self.remove(*key)
+            return False
+        return True
+
+    def remove(self, site, field, elev, dt):
+        with self._db() as db:
+            db.execute("DELETE FROM sweeps WHERE site=? AND field=? AND elev=? AND dt=?", (site, field, elev, dt))
+
+    def _forget(self, fnames):
+        with self._db() as db:
+            db.executemany("DELETE FROM sweeps WHERE fname=?", [ (fname,) for fname in fnames ])
@@ -1,14 +1,140 @@
 
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
 import aiohttp
 
-async def download(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            return await resp.read()
+_client = None
 
-if __name__ == "__main__":
-    import asyncio
+def get_client():
+    global _client
+    if _client is None:
+        _client = HTTPClient()
+
+    return _client
+
+
+def init_client(**kwargs):
+    global _client
+    _client = HTTPClient(**kwargs)
+    return _client
+
+
+class HTTPClient(object):
+    # Long-lived client with one pooled session, so repeat polls of the same hosts reuse keep-alive connections
+    # instead of doing a new TCP (and DNS) handshake every time.
+    def __init__(self, limit=64, limit_per_host=8, timeout=60, retries=2, backoff=1., max_validators=512):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._retries = retries
+        self._backoff = backoff
+
+        self._session = None
+
+        # url -> (ETag, Last-Modified, body) for conditional requests
+        self._validators = OrderedDict()
+        self._max_validators = max_validators
+
+        self.n_requests = 0
+        self.n_not_modified = 0
+        self.n_retries = 0
+        self.n_bytes = 0
+        self.total_latency = 0.
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.INFO)
+
+    async def get(self, url, headers=None, conditional=False):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+
+        headers = dict(headers) if headers is not None else {}
+        validator = self._validators.get(url) if conditional else None
+        if validator is not None:
+            etag, last_mod, _ = validator
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_mod is not None:
+                headers['If-Modified-Since'] = last_mod
+
+        attempt = 0
+        while True:
+            t_start = time.time()
+            try:
+                async with self._session.get(url, headers=headers) as resp:
+                    if resp.status >= 500:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                                                          message=resp.reason)
+                    body = await resp.read()
+                    status = resp.status
+                    resp_headers = resp.headers
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if attempt >= self._retries:
+                    raise
 
+                delay = self._backoff * 2 ** attempt
+                self._logger.info(f"Retrying {url} in {delay:.1f} s ({exc})")
+                self.n_retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        latency = time.time() - t_start
+        self.n_requests += 1
+        self.n_bytes += len(body)
+        self.total_latency += latency
+
+        if status == 304 and validator is not None:
+            self.n_not_modified += 1
+            self._validators.move_to_end(url)
+            body = validator[2]
+        elif conditional and status == 200:
+            etag = resp_headers.get('ETag')
+            last_mod = resp_headers.get('Last-Modified')
+            if etag is not None or last_mod is not None:
+                self._validators[url] = (etag, last_mod, body)
+                self._validators.move_to_end(url)
+                while len(self._validators) > self._max_validators:
+                    self._validators.popitem(last=False)
+
+        self._logger.debug(f"GET {url}: {status}, {len(body)} bytes in {latency:.2f} s")
+        return status, body
+
+    def stats(self):
+        n = max(self.n_requests, 1)
+        return {'n_requests': self.n_requests, 'n_not_modified': self.n_not_modified, 'n_retries': self.n_retries,
+                'n_bytes': self.n_bytes, 'mean_latency': self.total_latency / n}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+async def download(url, conditional=False):
+    _, body = await get_client().get(url, conditional=conditional)
+    return body
+
+
+async def download_range(url, start=0):
+    headers = {'Range': f"bytes={start}-"} if start > 0 else {}
+    status, body = await get_client().get(url, headers=headers)
+
+    # Nothing past `start` yet (or no file at all yet)
+    if status in [ 404, 416 ]:
+        return b""
+
+    # The server ignored the range and sent the whole thing
+    if status == 200 and start > 0:
+        body = body[start:]
+    return body
+
+
+if __name__ == "__main__":
     async def test_download(url):
         print(await download(url))
 
@@ -0,0 +1,111 @@
+
+import numpy as np
+
+import json
+import base64
+import struct
+
+# Binary frame layout (all integers little-endian):
+#   4 bytes   magic (b'MSF1')
+#   4 bytes   header length in bytes (uint32)
+#   n bytes   header, UTF-8 JSON, padded with spaces to a multiple of 8 bytes
+#   ...       raw array bytes, each array starting on an 8-byte boundary
+#
+# The header is the message itself with every array replaced by {"$array": i}, plus an "arrays" list that describes
+# array i as {"dtype": <numpy dtype string>, "shape": [...], "offset": <bytes from the start of the array section>,
+# "nbytes": <length in bytes>}.
+_magic = b'MSF1'
+_align = 8
+
+wire_formats = ['json', 'binary']
+
+
+def _little_endian(arr):
+    arr = np.ascontiguousarray(arr)
+    if arr.dtype.byteorder == '>':
+        arr = arr.astype(arr.dtype.newbyteorder('<'))
+    return arr
+
+
+def _pad(n_bytes):
+    return (-n_bytes) % _align
+
+
+def encode_json(msg):
+    # Legacy encoding: arrays go into the document as base64 strings.
+    def default(obj):
+        if isinstance(obj, np.ndarray):
+            return base64.b64encode(_little_endian(obj).tobytes()).decode('ascii')
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    return json.dumps(msg, default=default)
+
+
+def encode_binary(msg):
+    arrays = []
+    descriptors = []
+    offset = 0
+
+    def default(obj):
+        nonlocal offset
+        if isinstance(obj, np.ndarray):
+            arr = _little_endian(obj)
+            descriptors.append({'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset,
+                                'nbytes': arr.nbytes})
+            arrays.append(arr)
+            offset += arr.nbytes + _pad(arr.nbytes)
+            return {'$array': len(arrays) - 1}
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    header = json.loads(json.dumps(msg, default=default))
+    header['arrays'] = descriptors
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b" " * _pad(len(header_bytes))
+
+    chunks = [ _magic, struct.pack('<I', len(header_bytes)), header_bytes ]
+    for arr in arrays:
+        chunks.append(memoryview(arr.reshape(-1).view(np.uint8)))
+        chunks.append(b"\0" * _pad(arr.nbytes))
+    return b"".join(chunks)
+
+
+def decode_binary(frame):
+    if frame[:4] != _magic:
+        raise ValueError("Not a binary frame")
+
+    header_len, = struct.unpack('<I', frame[4:8])
+    header = json.loads(frame[8:(8 + header_len)].decode('utf-8'))
+    data_start = 8 + header_len
+
+    arrays = []
+    for desc in header.pop('arrays'):
+        start = data_start + desc['offset']
+        arr = np.frombuffer(frame[start:(start + desc['nbytes'])], dtype=np.dtype(desc['dtype']))
+        arrays.append(arr.reshape(desc['shape']))
+
+    def fill(obj):
+        if isinstance(obj, dict):
+            if list(obj.keys()) == ['$array']:
+                return arrays[obj['$array']]
+            return {k: fill(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [ fill(v) for v in obj ]
+        return obj
+
+    return fill(header)
+
+
+# Cache-friendly JSON hooks that keep the dtype and shape of arrays so they can be rebuilt on load.
+def dump_arrays(obj):
+    if isinstance(obj, np.ndarray):
+        arr = _little_endian(obj)
+        return {'__ndarray__': base64.b64encode(arr.tobytes()).decode('ascii'), 'dtype': arr.dtype.str,
+                'shape': list(arr.shape)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def load_arrays(dct):
+    if '__ndarray__' in dct:
+        arr = np.frombuffer(base64.b64decode(dct['__ndarray__']), dtype=np.dtype(dct['dtype']))
+        return arr.reshape(dct['shape'])
+    return dct
@@ -0,0 +1,100 @@
+
+import bz2
+import struct
+
+# A Level II archive file is a 24-byte volume header followed by LDM records. Each record is a 4-byte big-endian
+# control word giving the size of the bzip2-compressed block that follows (negative on some records, so take the
+# absolute value).
+volume_header_size = 24
+
+
+# Returns the offset just past the last complete record in a (possibly partial) Level II file, or 0 if there isn't
+# one yet. `start` has to be on a record boundary.
+def complete_records(buf, start=volume_header_size):
+    if len(buf) < volume_header_size:
+        return 0
+
+    offset = start
+    end = 0
+    while offset + 4 <= len(buf):
+        size, = struct.unpack('>i', buf[offset:(offset + 4)])
+        rec_end = offset + 4 + abs(size)
+        if size == 0 or rec_end > len(buf):
+            break
+
+        end = offset = rec_end
+    return end
+
+
+def record_offsets(buf, start=volume_header_size):
+    offsets = []
+    end = complete_records(buf, start=start)
+    offset = start
+    while offset < end:
+        offsets.append(offset)
+        size, = struct.unpack('>i', buf[offset:(offset + 4)])
+        offset += 4 + abs(size)
+    offsets.append(end)
+    return offsets
+
+
+# Inside a record's bzip2 block are messages, each behind a 12-byte CTM header and a 16-byte message header. Message
+# 31 (a radial) is as long as its header says; everything else comes in fixed-size frames. A radial's status says
+# whether it ends a sweep (2) or the whole volume (4).
+_msg_header_size = 12 + 16
+_fixed_msg_size = 2432
+_radial_status_offset = _msg_header_size + 21
+_sweep_end_status = (2, 4)
+
+
+# Counts the radials that end a sweep in a run of complete LDM records (`raw` starts on a record boundary). This only
+# decompresses the records, which is much cheaper than decoding the volume.
+def sweep_ends(raw):
+    n_ends = 0
+    offset = 0
+    while offset + 4 <= len(raw):
+        size, = struct.unpack('>i', raw[offset:(offset + 4)])
+        block = bz2.decompress(raw[(offset + 4):(offset + 4 + abs(size))])
+        offset += 4 + abs(size)
+
+        pos = 0
+        while pos + _radial_status_offset < len(block):
+            msg_size, = struct.unpack('>H', block[(pos + 12):(pos + 14)])
+            if block[pos + 15] == 31:
+                if block[pos + _radial_status_offset] in _sweep_end_status:
+                    n_ends += 1
+                pos += 12 + max(2 * msg_size, _msg_header_size - 12)
+            else:
+                pos += _fixed_msg_size
+    return n_ends
+
+if __name__ == "__main__":
+    # Local stand-in for the Level II server that serves a file as if it were still being written: one more LDM
+    # record becomes visible every few seconds. Range requests are honored, like the real server.
+    #   python metr_stream/utils/ldm.py KTLX20130520_200356_V06 [seconds per record]
+    import sys
+    import time
+    from aiohttp import web
+
+    fname = sys.argv[1]
+    rec_intv = float(sys.argv[2]) if len(sys.argv) > 2 else 2.
+
+    full = open(fname, 'rb').read()
+    offsets = record_offsets(full)
+    t_start = time.time()
+
+    async def growing_file(request):
+        n_recs = min(int((time.time() - t_start) / rec_intv) + 1, len(offsets))
+        visible = full[:offsets[n_recs - 1]] if n_recs > 1 else full[:volume_header_size]
+
+        rng = request.http_range
+        start = rng.start or 0
+        if start >= len(visible):
+            return web.Response(status=416)
+
+        status = 206 if rng.start is not None else 200
+        return web.Response(body=visible[start:rng.stop], status=status)
+
+    app = web.Application()
+    app.add_routes([web.get('/data/l2raw/{name}', growing_file)])
+    web.run_app(app, host="127.0.0.1", port=8000)
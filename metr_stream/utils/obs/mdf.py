@@ -1,4 +1,6 @@
 
+import numpy as np
+
 from io import StringIO
 from datetime import datetime
 
@@ -36,6 +38,18 @@ def dtypetostr(dat, width=None, prec=1):
     return dat_str
 
 
+def strarraytodtype(dat_strs):
+    # Same idea as strtodtype(), but for a whole column at once: int if every value is an int, float if every value
+    # is a number, otherwise strings.
+    try:
+        return dat_strs.astype(np.int64)
+    except ValueError:
+        try:
+            return dat_strs.astype(np.float64)
+        except ValueError:
+            return np.char.strip(dat_strs, '"')
+
+
 class MDF(object):
     def __init__(self, base_time, cols, comment="", colwidths=None):
         self._base_time = base_time
@@ -44,7 +58,7 @@ class MDF(object):
         self._colwidths = colwidths if colwidths is not None else [ 6 ] * len(cols)
         self._format = 101
 
-        self._rows = dict( (k, []) for k in cols )
+        self._rows = dict( (k, np.array([])) for k in cols )
 
     @classmethod
     def from_string(cls, text):
@@ -65,22 +79,26 @@ class MDF(object):
         cols = sio.readline().strip().split()
 
         mdf = cls(base_dt, cols, comment=comment)
-        for line in sio:
-            mdf.appendrow(**dict(zip(cols, ( strtodtype(v) for v in line.strip().split() ))))
 
+        # Split the whole body at once and infer each column's type once, instead of parsing cell by cell.
+        cells = np.array(sio.read().split())
+        if len(cells) % len(cols) != 0:
+            raise ValueError("MDF body doesn't have the same number of values in every row")
+
+        cells = cells.reshape(-1, len(cols))
+        mdf._rows = dict( (c, strarraytodtype(cells[:, ic])) for ic, c in enumerate(cols) )
         return mdf
 
     def appendrow(self, **data):
         for k, v in data.items():
-            self._rows[k].append(v)
-        self._cols = list(self._rows.keys())
+            self._rows[k] = np.append(self._rows[k], v)
 
     def __getitem__(self, key):
         ret_val = None
         if type(key) in [ int, slice ]:
             ret_val = dict( (c, self._rows[c][key]) for c in self._rows.keys() )
         elif type(key) == str:
-            ret_val = np.array(self._rows[key])
+            ret_val = self._rows[key]
         return ret_val
 
     def __iter__(self):
@@ -97,5 +115,3 @@ class MDF(object):
     @property
     def base_time(self):
         return self._base_time
-
-
@@ -0,0 +1,45 @@
+
+from collections import OrderedDict
+
+class PayloadCache(object):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, key):
+        try:
+            frame = self._frames[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._frames.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += len(frame[0])
+        return frame
+
+    def put(self, key, payload, is_binary):
+        if len(payload) > self._max_bytes:
+            return
+
+        if key in self._frames:
+            self._n_bytes -= len(self._frames.pop(key)[0])
+
+        self._frames[key] = (payload, is_binary)
+        self._n_bytes += len(payload)
+
+        while self._n_bytes > self._max_bytes:
+            _, (old_payload, _) = self._frames.popitem(last=False)
+            self._n_bytes -= len(old_payload)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_saved': self.bytes_saved,
+                'n_frames': len(self._frames), 'n_bytes': self._n_bytes}
+
+    def __len__(self):
+        return len(self._frames)
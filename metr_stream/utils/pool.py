@@ -0,0 +1,73 @@
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+_pool = None
+
+def get_decode_pool():
+    global _pool
+    if _pool is None:
+        _pool = DecodePool()
+
+    return _pool
+
+
+def init_decode_pool(**kwargs):
+    global _pool
+    _pool = DecodePool(**kwargs)
+    return _pool
+
+
+def _timed_call(func, *args):
+    t_start = time.time()
+    result = func(*args)
+    t_end = time.time()
+    return t_start, t_end, result
+
+
+class DecodePool(object):
+    def __init__(self, max_workers=2, max_per_worker=1):
+        self._max_workers = max_workers
+        self._max_in_flight = max_workers * max_per_worker
+
+        self._executor = None
+        self._sem = None
+
+        self.n_decodes = 0
+        self.total_wait = 0.
+        self.total_decode = 0.
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.INFO)
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+            self._sem = asyncio.Semaphore(self._max_in_flight)
+
+        # Time spent waiting on the semaphore or for a free worker counts as queue wait, not decode time.
+        t_submit = time.time()
+        async with self._sem:
+            loop = asyncio.get_event_loop()
+            t_start, t_end, result = await loop.run_in_executor(self._executor, _timed_call, func, *args)
+
+        wait = t_start - t_submit
+        decode = t_end - t_start
+
+        self.n_decodes += 1
+        self.total_wait += wait
+        self.total_decode += decode
+
+        self._logger.info(f"{func.__name__}: waited {wait:.2f} s, decoded in {decode:.2f} s")
+        return result
+
+    def stats(self):
+        n = max(self.n_decodes, 1)
+        return {'n_decodes': self.n_decodes, 'mean_wait': self.total_wait / n, 'mean_decode': self.total_decode / n}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
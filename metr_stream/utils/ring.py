@@ -0,0 +1,150 @@
+
+import json
+import mmap
+import os
+import struct
+
+# Memory-mapped ring buffer with one writer (the ingest process) and any number of readers (the websocket workers).
+# Layout (all integers little-endian):
+#   4 bytes   magic (b'MSRB')
+#   4 bytes   unused
+#   8 bytes   capacity of the record area (uint64)
+#   8 bytes   write position: total bytes ever written to the record area, so it only ever goes up (uint64)
+#   8 bytes   claimed position: the end of the record being written, which is set before the record is copied in
+#             and so is past the write position while a write is going on (uint64)
+#   ...       unused, up to 64 bytes
+#   ...       record area
+#
+# Each record is a uint32 record length (including this prefix), a uint32 header length, a UTF-8 JSON header, and the
+# payload, padded out to a multiple of 8 bytes. A record that won't fit before the end of the record area goes at the
+# start of the next lap instead, with a length of 0xffffffff left behind to say so (if there's room for it).
+#
+# Readers keep their own position. A reader that falls more than a lap behind the claimed position has lost whatever
+# was (or is being) overwritten and skips ahead to the current write position.
+_magic = b'MSRB'
+_header_size = 64
+_wrap = 0xffffffff
+
+
+def _pad(n_bytes):
+    return (-n_bytes) % 8
+
+
+class RingBuffer(object):
+    def __init__(self, path, capacity=None):
+        if capacity is not None:
+            with open(path, 'wb') as ringf:
+                ringf.truncate(_header_size + capacity)
+
+        self._file = open(path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+
+        if capacity is not None:
+            self._mm[0:4] = _magic
+            struct.pack_into('<QQQ', self._mm, 8, capacity, 0, 0)
+        elif self._mm[0:4] != _magic:
+            raise ValueError(f"{path} isn't a ring buffer")
+
+        self.capacity, = struct.unpack_from('<Q', self._mm, 8)
+
+    @classmethod
+    def create(cls, path, capacity):
+        return cls(path, capacity=capacity)
+
+    @property
+    def write_pos(self):
+        return struct.unpack_from('<Q', self._mm, 16)[0]
+
+    @property
+    def claim_pos(self):
+        return struct.unpack_from('<Q', self._mm, 24)[0]
+
+    def write(self, header, payload):
+        header_bytes = json.dumps(header).encode('utf-8')
+        length = 8 + len(header_bytes) + len(payload)
+        stride = length + _pad(length)
+        if stride > self.capacity:
+            raise ValueError(f"Record of {length} bytes is bigger than the ring ({self.capacity} bytes)")
+
+        pos = self.write_pos
+        offset = pos % self.capacity
+        if offset + stride > self.capacity:
+            if self.capacity - offset >= 8:
+                struct.pack_into('<I', self._mm, _header_size + offset, _wrap)
+            pos += self.capacity - offset
+            offset = 0
+
+        # Readers check this after copying a record, so they can tell if the writer was overwriting it meanwhile
+        struct.pack_into('<Q', self._mm, 24, pos + stride)
+
+        start = _header_size + offset
+        struct.pack_into('<II', self._mm, start, length, len(header_bytes))
+        self._mm[(start + 8):(start + 8 + len(header_bytes))] = header_bytes
+        self._mm[(start + 8 + len(header_bytes)):(start + 8 + len(header_bytes) + len(payload))] = payload
+
+        # Readers only look as far as the write position, so the record has to be all there before it moves
+        pos += stride
+        struct.pack_into('<Q', self._mm, 16, pos)
+        return pos
+
+    def read(self, pos, end=None):
+        # Returns the (header, payload) records from pos up to end (the current write position by default), the
+        # position to read from next time, and how many bytes were lost to the writer lapping this reader.
+        if end is None:
+            end = self.write_pos
+
+        lost = 0
+        if end - pos > self.capacity:
+            lost = end - pos
+            pos = end
+
+        records = []
+        while pos < end:
+            if self.claim_pos - pos > self.capacity:
+                lost += end - pos
+                pos = end
+                break
+
+            offset = pos % self.capacity
+            if self.capacity - offset < 8:
+                pos += self.capacity - offset
+                continue
+
+            start = _header_size + offset
+            length, header_len = struct.unpack_from('<II', self._mm, start)
+            if length == _wrap:
+                pos += self.capacity - offset
+                continue
+
+            stride = length + _pad(length)
+            if length < 8 or header_len > length - 8 or offset + stride > self.capacity:
+                # Torn by the writer; there's no telling where the next record starts, so give up on the rest
+                lost += end - pos
+                pos = end
+                break
+
+            header = bytes(self._mm[(start + 8):(start + 8 + header_len)])
+            payload = bytes(self._mm[(start + 8 + header_len):(start + length)])
+
+            # The writer may have come around and started overwriting this record while it was being copied
+            if self.claim_pos - pos > self.capacity:
+                lost += stride
+            else:
+                try:
+                    records.append((json.loads(header.decode('utf-8')), payload))
+                except ValueError:
+                    lost += stride
+            pos += stride
+
+        return records, pos, lost
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+def ring_path(name):
+    # Shared memory if there is any, otherwise the temp directory
+    shm_dir = "/dev/shm"
+    base_dir = shm_dir if os.path.isdir(shm_dir) else os.environ.get('TMPDIR', "/tmp")
+    return os.path.join(base_dir, name)
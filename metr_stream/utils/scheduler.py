@@ -0,0 +1,109 @@
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+_scheduler = None
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+
+    return _scheduler
+
+
+def init_scheduler(**kwargs):
+    global _scheduler
+    _scheduler = Scheduler(**kwargs)
+    return _scheduler
+
+
+class Scheduler(object):
+    # One task and a heap of due times for every handler's next fetch, instead of a sleeping timer task per handler.
+    # Each key has at most one pending callback; scheduling it again replaces the old one.
+    def __init__(self, report_every=100):
+        self._heap = []
+        self._pending = {}   # key -> (due, seq, callback); heap items that don't match are stale and get skipped
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._report_every = report_every
+
+        self.n_fired = 0
+        self.n_failed = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.INFO)
+
+    def schedule(self, key, delay, callback):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+        due = time.time() + max(delay, 0)
+        seq = next(self._seq)
+        self._pending[key] = (due, seq, callback)
+        heapq.heappush(self._heap, (due, seq, key))
+
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._pending.pop(key, None)
+
+    def next_due(self, key):
+        entry = self._pending.get(key)
+        return None if entry is None else entry[0]
+
+    async def _run(self):
+        while True:
+            while len(self._heap) > 0 and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            timeout = self._heap[0][0] - time.time() if len(self._heap) > 0 else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            now = time.time()
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                item = heapq.heappop(self._heap)
+                if self._is_stale(item):
+                    continue
+
+                due, _, key = item
+                _, _, callback = self._pending.pop(key)
+                asyncio.ensure_future(self._fire(key, callback, now - due))
+
+    def _is_stale(self, item):
+        due, seq, key = item
+        entry = self._pending.get(key)
+        return entry is None or entry[1] != seq
+
+    async def _fire(self, key, callback, lateness):
+        self.n_fired += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if self.n_fired % self._report_every == 0:
+            self._logger.info(f"Scheduler: {self.stats()}")
+
+        try:
+            await callback()
+        except Exception as exc:
+            self.n_failed += 1
+            self._logger.error(f"Error running scheduled {key}: {exc}")
+
+    def stats(self):
+        n = max(self.n_fired, 1)
+        return {'n_pending': len(self._pending), 'n_fired': self.n_fired, 'n_failed': self.n_failed,
+                'mean_lateness': self.total_lateness / n, 'max_lateness': self.max_lateness}
+
+    def __len__(self):
+        return len(self._pending)
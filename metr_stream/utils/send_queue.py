@@ -0,0 +1,99 @@
+
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+
+class SendQueue(object):
+    # Outgoing frames for one connection, sent by their own task so a slow client only holds up itself. A frame with
+    # a key replaces one with the same key that's still waiting to go out, and moves to the back of the queue (behind
+    # anything it depends on that was queued since). With replace=False, the new frame is the one that's dropped
+    # instead. Frames without a key are always sent, in order. If the queue is over its limits anyway, the oldest
+    # droppable frames (ones with keys) go to make room. If that isn't enough, the new frame isn't queued, and the
+    # queue is marked as overflowed so the connection can be dropped.
+    def __init__(self, send, max_frames=32, max_bytes=64 * 1024 ** 2):
+        self._send = send
+        self._max_frames = max_frames
+        self._max_bytes = max_bytes
+
+        self._frames = OrderedDict()   # ('key', key) or ('seq', n) -> (payload, is_binary, droppable)
+        self._seq = itertools.count()
+        self._n_bytes = 0
+        self._has_work = asyncio.Event()
+        self._busy_since = None
+        self._closed = False
+        self.overflowed = False
+
+        self.n_sent = 0
+        self.n_coalesced = 0
+        self.n_dropped = 0
+        self.max_depth = 0
+
+    def put(self, payload, is_binary=False, key=None, replace=True, droppable=True):
+        if self._closed:
+            raise ValueError("Connection is closed")
+
+        if key is not None and ('key', key) in self._frames:
+            self.n_coalesced += 1
+            if not replace:
+                return
+            self._remove(('key', key))
+
+        while self._is_full(payload):
+            oldest = next((qkey for qkey, frame in self._frames.items() if frame[2]), None)
+            if oldest is None:
+                self.overflowed = True
+                return
+            self._remove(oldest)
+            self.n_dropped += 1
+
+        qkey = ('key', key) if key is not None else ('seq', next(self._seq))
+        self._frames[qkey] = (payload, is_binary, droppable and key is not None)
+        self._n_bytes += len(payload)
+        self.max_depth = max(self.max_depth, len(self._frames))
+
+        if self._busy_since is None:
+            self._busy_since = time.time()
+        self._has_work.set()
+
+    def lag(self):
+        # How long the queue has gone without being emptied
+        return 0. if self._busy_since is None else time.time() - self._busy_since
+
+    def close(self):
+        self._closed = True
+        self._frames.clear()
+        self._n_bytes = 0
+
+    async def run(self):
+        while not self._closed:
+            await self._has_work.wait()
+            while len(self._frames) > 0:
+                qkey, (payload, is_binary, _) = self._frames.popitem(last=False)
+                self._n_bytes -= len(payload)
+                try:
+                    await self._send(payload, is_binary)
+                except Exception:
+                    self.close()
+                    raise
+                self.n_sent += 1
+
+            self._has_work.clear()
+            self._busy_since = None
+
+    def _is_full(self, payload):
+        return len(self._frames) > 0 and (len(self._frames) >= self._max_frames or
+                                          self._n_bytes + len(payload) > self._max_bytes)
+
+    def _remove(self, qkey):
+        payload, _, _ = self._frames.pop(qkey)
+        self._n_bytes -= len(payload)
+
+    def stats(self):
+        return {'depth': len(self._frames), 'n_bytes': self._n_bytes, 'lag': self.lag(), 'n_sent': self.n_sent,
+                'n_coalesced': self.n_coalesced, 'n_dropped': self.n_dropped, 'max_depth': self.max_depth,
+                'overflowed': self.overflowed}
+
+    def __len__(self):
+        return len(self._frames)
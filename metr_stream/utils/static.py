@@ -1,6 +1,10 @@
 
 import os
 import json
+import hashlib
+
+_assets = {}
+_hashes = {}
 
 def _get_static_path():
     static_path = os.path.join(__file__, '..', '..', '..', 'static')
@@ -14,3 +18,46 @@ def get_static(fname):
         static_json = json.loads(statf.read().decode('utf-8'))
 
     return static_json
+
+
+class Asset(object):
+    # A file that's read once and kept in memory, along with a hash of its contents. get_asset() reads it again if
+    # the file's mtime changes.
+    def __init__(self, fname, mtime, raw):
+        self.fname = fname
+        self.mtime = mtime
+        self.hash = hashlib.sha1(raw).hexdigest()[:16]
+        self._raw = raw
+        self._content = None
+
+    def content(self, parse):
+        if self._content is None:
+            self._content = parse(self._raw)
+            self._raw = None
+        return self._content
+
+
+def get_asset(fname):
+    mtime = os.path.getmtime(fname)
+    asset = _assets.get(fname)
+    if asset is None or asset.mtime != mtime:
+        with open(fname, 'rb') as assetf:
+            asset = Asset(fname, mtime, assetf.read())
+        _assets[fname] = asset
+
+    return asset
+
+
+def get_file_hash(fname):
+    # Same hash as get_asset(), for files whose contents are kept some other way. The file is read in pieces and not
+    # kept, and is only read again if its mtime changes.
+    mtime = os.path.getmtime(fname)
+    cached = _hashes.get(fname)
+    if cached is None or cached[0] != mtime:
+        file_hash = hashlib.sha1()
+        with open(fname, 'rb') as hashf:
+            for chunk in iter(lambda: hashf.read(1024 ** 2), b''):
+                file_hash.update(chunk)
+        cached = _hashes[fname] = (mtime, file_hash.hexdigest()[:16])
+
+    return cached[1]
@@ -0,0 +1,83 @@
+
+import heapq
+from collections import defaultdict
+from math import radians, sin, cos, asin, sqrt, floor
+
+from metr_stream.utils.static import get_static
+
+_earth_radius = 6371.
+
+_registries = {}
+
+
+def radars():
+    if 'wsr88ds' not in _registries:
+        sites = { st['id']: st for st in get_static('wsr88ds.json') }
+        _registries['wsr88ds'] = StationRegistry(sites, 'latitude', 'longitude')
+
+    return _registries['wsr88ds']
+
+
+def mesonet():
+    if 'okmesonet' not in _registries:
+        _registries['okmesonet'] = StationRegistry(get_static('okmesonet.json'), 'LAT', 'LON')
+
+    return _registries['okmesonet']
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    hav = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * _earth_radius * asin(sqrt(hav))
+
+
+class StationRegistry(object):
+    # Loaded once, with dict lookups by station id and a lat/lon grid for spatial queries.
+    def __init__(self, stations, lat_key, lon_key, cell_size=2.):
+        self._stations = stations
+        self._cell = cell_size
+
+        self.lats = {}
+        self.lons = {}
+        self._grid = defaultdict(list)
+        for stid, st in stations.items():
+            lat, lon = float(st[lat_key]), float(st[lon_key])
+            self.lats[stid] = lat
+            self.lons[stid] = lon
+            self._grid[self._cell_idx(lat, lon)].append(stid)
+
+    def _cell_idx(self, lat, lon):
+        return (int(floor(lat / self._cell)), int(floor(lon / self._cell)))
+
+    def __getitem__(self, stid):
+        return self._stations[stid]
+
+    def __contains__(self, stid):
+        return stid in self._stations
+
+    def __iter__(self):
+        return iter(self._stations)
+
+    def __len__(self):
+        return len(self._stations)
+
+    def get(self, stid, default=None):
+        return self._stations.get(stid, default)
+
+    def nearest(self, lat, lon, n=5):
+        # The registries only have a few hundred stations, so checking all of them takes well under a millisecond, and
+        # unlike searching the grid outward, it doesn't get slow near the poles or far from any station.
+        dists = ( (great_circle(lat, lon, self.lats[stid], self.lons[stid]), stid) for stid in self._stations )
+        return [ (stid, dist) for dist, stid in heapq.nsmallest(n, dists) ]
+
+    def in_bbox(self, lat_min, lon_min, lat_max, lon_max):
+        ilat_min, ilon_min = self._cell_idx(lat_min, lon_min)
+        ilat_max, ilon_max = self._cell_idx(lat_max, lon_max)
+
+        stids = []
+        for jlat in range(ilat_min, ilat_max + 1):
+            for jlon in range(ilon_min, ilon_max + 1):
+                for stid in self._grid.get((jlat, jlon), []):
+                    if lat_min <= self.lats[stid] <= lat_max and lon_min <= self.lons[stid] <= lon_max:
+                        stids.append(stid)
+        return stids
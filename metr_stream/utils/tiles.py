@@ -0,0 +1,191 @@
+
+import numpy as np
+
+import asyncio
+import json
+import logging
+import zlib
+from collections import defaultdict
+
+from metr_stream.utils.pool import get_decode_pool
+from metr_stream.utils.static import get_file_hash
+
+# Tiles are on a plain lat/lon grid: at zoom z, each tile is 360 / 2 ** z degrees on a side, numbered from (-180, 90)
+# going east (x) and south (y). Coordinates in a tile are integers from its northwest corner, with `extent` units
+# across the tile. Lines are simplified to about a pixel at `tile_px` pixels per tile.
+max_zoom = 12
+extent = 4096
+tile_px = 256
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+
+
+def tile_size(zoom):
+    return 360. / 2 ** zoom
+
+
+def tile_counts(zoom):
+    # Tiles across and down; the grid is twice as wide as it is tall, except at zoom 0
+    return 2 ** zoom, max(1, 2 ** (zoom - 1))
+
+
+def tile_bounds(zoom, x, y):
+    size = tile_size(zoom)
+    lon_min, lat_max = -180. + x * size, 90. - y * size
+    return [ lon_min, lat_max - size, lon_min + size, lat_max ]
+
+
+class TileSet(object):
+    # Geometry from one shapefile, simplified and tiled once per zoom level and then kept in memory. Levels are built
+    # in the decode pool the first time somebody asks for them. The version is the hash of the file's contents, so
+    # the tiles get rebuilt if the file changes.
+    _tilesets = {}
+
+    def __init__(self, fname, version):
+        self._fname = fname
+        self._levels = {}
+        self._building = {}
+        self.version = version
+
+    @classmethod
+    def get(cls, fname):
+        version = get_file_hash(fname)
+        tileset = cls._tilesets.get(fname)
+        if tileset is None or tileset.version != version:
+            tileset = cls._tilesets[fname] = cls(fname, version)
+        return tileset
+
+    async def tile(self, zoom, x, y):
+        level = await self._level(zoom)
+        return level.get((x, y), (np.zeros(0, dtype=np.int16), np.zeros(1, dtype=np.uint32)))
+
+    async def _level(self, zoom):
+        if zoom in self._levels:
+            return self._levels[zoom]
+
+        if zoom not in self._building:
+            self._building[zoom] = asyncio.ensure_future(get_decode_pool().run(_build_level, self._fname, zoom))
+
+        build = self._building[zoom]
+        try:
+            level = await asyncio.shield(build)
+        finally:
+            if build.done() and self._building.get(zoom) is build:
+                del self._building[zoom]
+
+        if zoom not in self._levels:
+            self._levels[zoom] = level
+            n_bytes = sum(coords.nbytes + offsets.nbytes for coords, offsets in level.values())
+            _logger.info(f"Tiled {self._fname} at zoom {zoom}: {len(level)} tiles, {n_bytes} bytes")
+        return self._levels[zoom]
+
+
+def _lines(geometry):
+    if geometry is None:
+        return []
+
+    geo_type = geometry['type']
+    if geo_type == 'LineString':
+        return [ geometry['coordinates'] ]
+    elif geo_type in [ 'MultiLineString', 'Polygon' ]:
+        return geometry['coordinates']
+    elif geo_type == 'MultiPolygon':
+        return [ ring for polygon in geometry['coordinates'] for ring in polygon ]
+    elif geo_type == 'GeometryCollection':
+        return [ line for geom in geometry['geometries'] for line in _lines(geom) ]
+    return []
+
+
+def _split_at_tiles(points, size):
+    # Adds a point wherever the line crosses a tile edge, so every segment is inside one tile. Returns the points and
+    # the tile each segment is in.
+    pieces = [ points[:1] ]
+    for start, end in zip(points[:-1], points[1:]):
+        crossings = []
+        for dim, origin, sign in [ (0, -180., 1), (1, 90., -1) ]:
+            grid_start = (start[dim] - origin) * sign / size
+            grid_end = (end[dim] - origin) * sign / size
+            if grid_start != grid_end:
+                edges = np.arange(np.floor(min(grid_start, grid_end)) + 1, np.ceil(max(grid_start, grid_end)))
+                crossings.append((edges - grid_start) / (grid_end - grid_start))
+
+        if len(crossings) > 0:
+            frac = np.sort(np.concatenate(crossings))
+            pieces.append(start + frac[:, np.newaxis] * (end - start))
+        pieces.append(end[np.newaxis])
+
+    points = np.concatenate(pieces)
+    mid = (points[:-1] + points[1:]) / 2
+    tx = np.floor((mid[:, 0] + 180.) / size).astype(int)
+    ty = np.floor((90. - mid[:, 1]) / size).astype(int)
+    return points, tx, ty
+
+
+def simplify(points, tolerance):
+    # Douglas-Peucker, with a stack instead of recursion and the distances for each span done all at once
+    if len(points) < 3:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [ (0, len(points) - 1) ]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        seg = points[end] - points[start]
+        rel = points[(start + 1):end] - points[start]
+        seg_len = np.hypot(*seg)
+        if seg_len == 0:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dist = np.abs(seg[0] * rel[:, 1] - seg[1] * rel[:, 0]) / seg_len
+
+        imax = np.argmax(dist)
+        if dist[imax] > tolerance:
+            split = start + 1 + imax
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return points[keep]
+
+
+# Runs in a decode pool worker. Returns {(x, y): (coords, offsets)} for every tile at this zoom with anything in it,
+# where coords is a flat array of x, y pairs and line i is coords[offsets[i]:offsets[i + 1]] (in pairs).
+def _build_level(fname, zoom):
+    geo_json = json.loads(zlib.decompress(open(fname, 'rb').read()).decode('utf-8'))
+    if geo_json.get('type') == 'FeatureCollection':
+        geometries = [ feat.get('geometry') for feat in geo_json['features'] ]
+    else:
+        geometries = [ geo_json ]
+
+    size = tile_size(zoom)
+    tolerance = size / tile_px
+
+    tile_lines = defaultdict(list)
+    for geometry in geometries:
+        for line in _lines(geometry):
+            points = simplify(np.array(line, dtype=np.float64)[:, :2], tolerance)
+            if len(points) < 2:
+                continue
+
+            # Lines are clipped at tile edges, and each run of segments in the same tile is one line there. The point
+            # on the edge ends one run and starts the next, so the pieces still meet up.
+            points, tx, ty = _split_at_tiles(points, size)
+            breaks = np.nonzero((tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1]))[0] + 1
+            for start, end in zip([ 0 ] + list(breaks), list(breaks) + [ len(tx) ]):
+                tile_lines[(int(tx[start]), int(ty[start]))].append(points[start:(end + 1)])
+
+    level = {}
+    for (x, y), lines in tile_lines.items():
+        lon_min, _, _, lat_max = tile_bounds(zoom, x, y)
+        coords = np.concatenate(lines)
+        coords = np.round(np.column_stack([ coords[:, 0] - lon_min, lat_max - coords[:, 1] ]) * (extent / size))
+
+        offsets = np.cumsum([ 0 ] + [ len(line) for line in lines ]).astype(np.uint32)
+        level[(x, y)] = (coords.astype(np.int16).ravel(), offsets)
+    return level
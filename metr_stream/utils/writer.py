@@ -0,0 +1,117 @@
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+_writer = None
+
+def get_cache_writer():
+    global _writer
+    if _writer is None:
+        _writer = CacheWriter()
+
+    return _writer
+
+
+def init_cache_writer(**kwargs):
+    global _writer
+    _writer = CacheWriter(**kwargs)
+    return _writer
+
+
+class CacheWriter(object):
+    # Long-lived background writer for the disk caches. Writes are queued by key, so a second write for something
+    # that's still waiting (e.g. the same sweep from two handlers) replaces the first instead of being done twice.
+    # When the queue is full, `policy` decides what happens:
+    #   'block':        submit() waits for room (backpressure on whoever is fetching)
+    #   'drop_oldest':  the oldest queued write is thrown away
+    #   'drop_newest':  the new write is thrown away
+    _policies = ['block', 'drop_oldest', 'drop_newest']
+
+    def __init__(self, max_pending=256, policy='drop_oldest', n_threads=1, report_every=50):
+        if policy not in CacheWriter._policies:
+            raise ValueError(f"Unknown cache writer policy '{policy}'")
+
+        self._max_pending = max_pending
+        self._policy = policy
+        self._n_threads = n_threads
+        self._report_every = report_every
+
+        self._pending = OrderedDict()
+        self._has_work = asyncio.Event()
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+
+        self.n_written = 0
+        self.n_failed = 0
+        self.n_coalesced = 0
+        self.n_dropped = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.setLevel(logging.INFO)
+
+    async def submit(self, key, write):
+        if key in self._pending:
+            self._pending[key] = write
+            self.n_coalesced += 1
+            return
+
+        while len(self._pending) >= self._max_pending:
+            if self._policy == 'block':
+                await self._has_room.wait()
+            elif self._policy == 'drop_oldest':
+                self._pending.popitem(last=False)
+                self.n_dropped += 1
+            else:
+                self.n_dropped += 1
+                return
+
+        self._pending[key] = write
+        self._has_work.set()
+        if len(self._pending) >= self._max_pending:
+            self._has_room.clear()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self._n_threads)
+
+        try:
+            while True:
+                await self._has_work.wait()
+
+                key, write = self._pending.popitem(last=False)
+                if len(self._pending) == 0:
+                    self._has_work.clear()
+                self._has_room.set()
+
+                t_start = time.time()
+                try:
+                    await loop.run_in_executor(executor, write)
+                except Exception as exc:
+                    self.n_failed += 1
+                    self._logger.error(f"Error writing {key} to the cache: {exc}")
+                    continue
+
+                latency = time.time() - t_start
+                self.n_written += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+                self._logger.debug(f"Wrote {key} in {latency:.3f} s ({len(self._pending)} queued)")
+                if self.n_written % self._report_every == 0:
+                    self._logger.info(f"Cache writer: {self.stats()}")
+        finally:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        n = max(self.n_written, 1)
+        return {'depth': len(self._pending), 'n_written': self.n_written, 'n_failed': self.n_failed,
+                'n_coalesced': self.n_coalesced, 'n_dropped': self.n_dropped, 'mean_latency': self.total_latency / n,
+                'max_latency': self.max_latency}
+
+    def __len__(self):
+        return len(self._pending)